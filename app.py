@@ -1,16 +1,22 @@
 
 import streamlit as st
 import requests
-import time
+import json
 import os
+import hashlib
 
 # Configuration
 API_URL = "http://127.0.0.1:4567"
 UPLOAD_ENDPOINT = f"{API_URL}/upload"
 PROCESS_ENDPOINT = f"{API_URL}/process"
 STATUS_ENDPOINT = f"{API_URL}/status"
+EVENTS_ENDPOINT = f"{API_URL}/events"
 DOWNLOAD_ENDPOINT = f"{API_URL}/download"
 
+# Size of the pieces the PDF is sent in, and how many times a failed piece is resumed
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 3
+
 # Initialize session state
 if 'job_id' not in st.session_state:
     st.session_state.job_id = None
@@ -25,6 +31,49 @@ if 'progress' not in st.session_state:
 if 'total' not in st.session_state:
     st.session_state.total = 1
 
+
+def upload_in_chunks(uploaded_file):
+    """
+    Description: Send a file to the server in chunks, resuming from the server's offset if a chunk fails.
+        The file is not sent at all if the server already has a file with the same SHA-256.
+    Input:
+        uploaded_file: the file returned by st.file_uploader.
+    Return:
+        result: dict, the response of the server, with file_path, sha256 and duplicate.
+    """
+    sha256 = hashlib.sha256()
+    uploaded_file.seek(0)
+    for block in iter(lambda: uploaded_file.read(UPLOAD_CHUNK_SIZE), b""):
+        sha256.update(block)
+    response = requests.get(f"{UPLOAD_ENDPOINT}/hash/{sha256.hexdigest()}")
+    if response.status_code == 200:
+        return response.json()
+
+    response = requests.post(f"{UPLOAD_ENDPOINT}/init", json={"filename": uploaded_file.name})
+    response.raise_for_status()
+    upload_id = response.json()["upload_id"]
+    offset, retries = 0, 0
+    while offset < uploaded_file.size:
+        uploaded_file.seek(offset)
+        chunk = uploaded_file.read(UPLOAD_CHUNK_SIZE)
+        try:
+            response = requests.put(f"{UPLOAD_ENDPOINT}/{upload_id}", params={"offset": offset}, data=chunk)
+            response.raise_for_status()
+            offset = response.json()["offset"]
+        except requests.exceptions.RequestException:
+            retries += 1
+            if retries > UPLOAD_RETRIES:
+                raise
+            # Ask the server how much it received, and resume from there
+            response = requests.get(f"{UPLOAD_ENDPOINT}/{upload_id}")
+            response.raise_for_status()
+            offset = response.json()["offset"]
+
+    response = requests.post(f"{UPLOAD_ENDPOINT}/{upload_id}/complete")
+    response.raise_for_status()
+    return response.json()
+
+
 st.title("DAISY Book Generator")
 
 # --- 1. File Upload ---
@@ -33,14 +82,15 @@ uploaded_file = st.file_uploader("Choose a PDF file", type="pdf")
 if uploaded_file is not None:
     if st.session_state.file_path is None:
         with st.spinner('Uploading file...'):
-            files = {'file': (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)}
             try:
-                response = requests.post(UPLOAD_ENDPOINT, files=files)
-                if response.status_code == 200:
-                    st.session_state.file_path = response.json().get("file_path")
-                    st.success(f"File uploaded successfully: {os.path.basename(st.session_state.file_path)}")
+                result = upload_in_chunks(uploaded_file)
+                st.session_state.file_path = result.get("file_path")
+                if result.get("duplicate"):
+                    st.success(f"File already on the server: {os.path.basename(st.session_state.file_path)}")
                 else:
-                    st.error(f"Error uploading file: {response.text}")
+                    st.success(f"File uploaded successfully: {os.path.basename(st.session_state.file_path)}")
+            except requests.exceptions.HTTPError as e:
+                st.error(f"Error uploading file: {e.response.text}")
             except requests.exceptions.ConnectionError as e:
                 st.error(f"Connection Error: Could not connect to the server at {API_URL}. Please ensure the server is running.")
 
@@ -84,14 +134,21 @@ if st.session_state.job_id and not st.session_state.processing_complete:
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    while not st.session_state.processing_complete:
-        try:
-            status_response = requests.get(f"{STATUS_ENDPOINT}/{st.session_state.job_id}")
-            if status_response.status_code == 200:
-                data = status_response.json()
-                st.session_state.status = data.get("status", "Unknown status...")
-                st.session_state.progress = data.get("progress", 0)
-                st.session_state.total = data.get("total", 1)
+    detail_text = st.empty()
+
+    # The server pushes progress events (Server-Sent Events) until the job ends
+    try:
+        with requests.get(f"{EVENTS_ENDPOINT}/{st.session_state.job_id}", stream=True, timeout=(5, None)) as response:
+            if response.status_code != 200:
+                st.error(f"Error getting status: {response.text}")
+            state = {}
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue  # keep-alive comments and event separators
+                state.update(json.loads(line[len("data: "):]))
+                st.session_state.status = state.get("status") or "Unknown status..."
+                st.session_state.progress = state.get("progress") or 0
+                st.session_state.total = state.get("total") or 1
 
                 # Update UI
                 progress = st.session_state.progress
@@ -103,23 +160,25 @@ if st.session_state.job_id and not st.session_state.processing_complete:
                 
                 progress_bar.progress(min(progress_value, 1.0))
                 status_text.text(f"Status: {st.session_state.status}")
+                if state.get("stage") == "tts" and state.get("chunks"):
+                    detail = f"Chapter {state.get('chapter')}: chunk {state.get('chunk')}/{state.get('chunks')}"
+                    if state.get("rtf") is not None:
+                        detail += f" | RTF {state['rtf']:.3f}"
+                    if state.get("eta") is not None:
+                        detail += f" | ETA {state['eta'] // 60}m {state['eta'] % 60}s"
+                    detail_text.text(detail)
 
                 if "finished" in st.session_state.status.lower():
                     st.session_state.processing_complete = True
                     st.success("Processing complete!")
+                    break
                 elif "error" in st.session_state.status.lower():
                     st.error(f"An error occurred: {st.session_state.status}")
                     break # Exit loop on error
-            else:
-                status_text.text("Waiting for server response...")
-
-            time.sleep(2) # Poll every 2 seconds
-        except requests.exceptions.ConnectionError as e:
-            st.error(f"Connection Error: Could not get status from the server. Halting updates.")
-            break
-        except Exception as e:
-            st.error(f"An unexpected error occurred: {e}")
-            break
+    except requests.exceptions.ConnectionError as e:
+        st.error(f"Connection Error: Could not get status from the server. Halting updates.")
+    except Exception as e:
+        st.error(f"An unexpected error occurred: {e}")
 
 
 # --- 4. Download ---
@@ -1,25 +1,54 @@
 import os
+import json
 import uuid
-import shutil
-import multiprocessing
+import asyncio
+import mimetypes
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from pydantic import BaseModel
 
 from src.daisy_maker import DaisyMaker
+from src.audio_process.tts_engine import get_tts_engine
+from src.job_queue import JobQueue, WorkerPool, EventHub
+from src.upload_store import UploadStore
+from src.stage_manifest import StageManifest
 
 app = FastAPI()
 
 # --- File and Directory Setup ---
 UPLOAD_DIR = Path("data/uploads")
 OUTPUT_DIR = Path("data/book_outputs")
-UPLOAD_DIR.mkdir(exist_ok=True)
-OUTPUT_DIR.mkdir(exist_ok=True)
+UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+# Uploads are stored by content hash, so an identical PDF is only stored once
+# Partial uploads that received no chunk for this many hours are deleted
+UPLOAD_PARTIAL_TTL_HOURS = float(os.environ.get("DAISY_UPLOAD_PARTIAL_TTL_HOURS", "24"))
+upload_store = UploadStore(UPLOAD_DIR, partial_ttl=UPLOAD_PARTIAL_TTL_HOURS * 3600)
+# Bytes read from a request before they are written to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# --- Job queue settings ---
+JOBS_DB_PATH = os.environ.get("DAISY_JOBS_DB", "data/jobs.db")
+NUM_WORKERS = int(os.environ.get("DAISY_NUM_WORKERS", "1"))
+
+# --- Audio settings ---
+AUDIO_FORMAT = os.environ.get("DAISY_AUDIO_FORMAT", "mp3")
+AUDIO_BITRATE = os.environ.get("DAISY_AUDIO_BITRATE", "64k")
+
+# --- Text settings ---
+# Pack chunks by the acoustic frames the TTS model predicts instead of by characters
+CHUNK_BY_FRAMES = os.environ.get("DAISY_CHUNK_BY_FRAMES", "0") == "1"
+
+# Seconds between keep-alive comments on an idle event stream
+EVENTS_KEEPALIVE = 15
 
 # --- Global variables (will be set later) ---
-manager = None
-jobs = None
+job_queue = None
+worker_pool = None
+event_hub = None
 
 
 class Book(BaseModel):
@@ -30,12 +59,34 @@ class Book(BaseModel):
     book_publisher: str
     book_uid: str
     chunk_size: int = 400
+    priority: int = 0
+
+
+class UploadInit(BaseModel):
+    filename: str
 
 @app.on_event("startup")
 def startup_event():
-    global manager, jobs
-    manager = multiprocessing.Manager()
-    jobs = manager.dict()
+    global job_queue, worker_pool, event_hub
+    upload_store.cleanup()
+    job_queue = JobQueue(JOBS_DB_PATH)
+    requeued = job_queue.requeue_running()
+    if requeued:
+        print(f"Requeued {requeued} interrupted jobs")
+    worker_pool = WorkerPool(JOBS_DB_PATH, run_daisy_creation, num_workers=NUM_WORKERS, init_fn=init_worker)
+    worker_pool.start()
+    event_hub = EventHub(worker_pool.events)
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if worker_pool is not None:
+        worker_pool.stop()
+    if event_hub is not None:
+        event_hub.stop()
+
+def init_worker():
+    """Load the TTS model once in each worker, so every job it runs starts warm."""
+    get_tts_engine()
 
 def run_daisy_creation(job_id: str, status_dict: dict, book_data: dict):
     """The target function to be run in a background process."""
@@ -64,7 +115,10 @@ def run_daisy_creation(job_id: str, status_dict: dict, book_data: dict):
             audio_output_dir=str(audio_output_dir),
             xml_output_dir=str(xml_output_dir),
             is_split_by_sentence=is_split_by_sentence,
-            chunk_size=book_data.get("chunk_size")
+            chunk_size=book_data.get("chunk_size"),
+            audio_format=AUDIO_FORMAT,
+            audio_bitrate=AUDIO_BITRATE,
+            chunk_by_frames=CHUNK_BY_FRAMES,
         )
 
         daisy_maker.create_daisy_for_book(
@@ -85,57 +139,181 @@ def run_daisy_creation(job_id: str, status_dict: dict, book_data: dict):
         status_dict["status"] = f"error: {e}"
 
 
+def upload_response(file_path, sha256, duplicate):
+    message = "File already uploaded" if duplicate else "File uploaded successfully"
+    return {"message": message, "file_path": file_path, "sha256": sha256, "duplicate": duplicate}
+
+
+# The upload store writes and hashes on disk: the handlers that call it are plain functions, run in the
+# thread pool by FastAPI, or await it through run_in_threadpool, so they never block the event loop
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
     try:
-        safe_filename = f"{uuid.uuid4()}_{file.filename}"
-        file_path = UPLOAD_DIR / safe_filename
-
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        return {"message": "File uploaded successfully", "file_path": str(file_path)}
+        upload_id = await run_in_threadpool(upload_store.start, file.filename)
+        offset = 0
+        # Read and hash the file one chunk at a time instead of holding it in memory
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            offset = await run_in_threadpool(upload_store.append, upload_id, offset, chunk)
+        return upload_response(*await run_in_threadpool(upload_store.complete, upload_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload error: {e}")
 
 
+@app.get("/upload/hash/{sha256}")
+def find_upload(sha256: str):
+    # Lets the client skip uploading a file the server already has
+    try:
+        file_path = upload_store.find(sha256.lower())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return upload_response(file_path, sha256.lower(), True)
+
+
+@app.post("/upload/init")
+def init_upload(upload: UploadInit):
+    upload_id = upload_store.start(upload.filename)
+    return {"upload_id": upload_id, "offset": 0}
+
+
+@app.get("/upload/{upload_id}")
+def get_upload_offset(upload_id: str):
+    # An interrupted client asks where to resume
+    try:
+        return {"upload_id": upload_id, "offset": upload_store.offset(upload_id)}
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+
+@app.put("/upload/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request):
+    try:
+        buffer = bytearray()
+        async for data in request.stream():
+            buffer += data
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                offset = await run_in_threadpool(upload_store.append, upload_id, offset, bytes(buffer))
+                buffer.clear()
+        if buffer:
+            offset = await run_in_threadpool(upload_store.append, upload_id, offset, bytes(buffer))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"upload_id": upload_id, "offset": offset}
+
+
+@app.post("/upload/{upload_id}/complete")
+def complete_upload(upload_id: str):
+    try:
+        return upload_response(*upload_store.complete(upload_id))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+
 @app.post("/process")
 async def process_book(book: Book):
-    if jobs is None:
-        raise HTTPException(status_code=500, detail="Job manager not initialized")
+    if job_queue is None:
+        raise HTTPException(status_code=500, detail="Job queue not initialized")
 
     job_id = str(uuid.uuid4())
     input_file_path = Path(book.input_file)
     if not input_file_path.exists():
         raise HTTPException(status_code=404, detail=f"Input file not found: {book.input_file}")
 
-    jobs[job_id] = manager.dict({
-        "status": "starting",
-        "progress": 0,
-        "total": 1,
-        "result_path": None
-    })
+    job_queue.submit(job_id, book.dict(), priority=book.priority)
+
+    return {"message": "Processing queued", "job_id": job_id}
 
-    process = multiprocessing.Process(
-        target=run_daisy_creation,
-        args=(job_id, jobs[job_id], book.dict())
-    )
-    process.start()
 
-    return {"message": "Processing started", "job_id": job_id}
+@app.post("/retry/{job_id}")
+async def retry_job(job_id: str):
+    # The job keeps its id and output directories, so it resumes from its completed stages
+    if job_queue is None or not job_queue.requeue(job_id):
+        raise HTTPException(status_code=404, detail="Job not found or still in progress")
+    return {"message": "Processing queued", "job_id": job_id}
 
 
 @app.get("/status/{job_id}")
 async def get_status(job_id: str):
-    job_status = jobs.get(job_id) if jobs else None
+    job_status = job_queue.get(job_id) if job_queue else None
     if job_status is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return dict(job_status)
+    return {**event_hub.snapshot(job_id), **job_status}
+
+
+@app.get("/events/{job_id}")
+async def stream_events(job_id: str):
+    if job_queue is None or event_hub is None:
+        raise HTTPException(status_code=500, detail="Job queue not initialized")
+    # Subscribe before reading the status, so an event sent in between is queued instead of lost
+    events = event_hub.subscribe(job_id)
+    job_status = job_queue.get(job_id)
+    if job_status is None:
+        event_hub.unsubscribe(job_id, events)
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        try:
+            # Start with the current state, so a late subscriber catches up
+            yield f"data: {json.dumps({**event_hub.snapshot(job_id), **job_status})}\n\n"
+            if job_status["state"] in ("finished", "error"):
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # The database is the source of truth, e.g. if the worker died without a final event
+                    current = await run_in_threadpool(job_queue.get, job_id)
+                    if current is not None and current["state"] in ("finished", "error"):
+                        yield f"data: {json.dumps(current)}\n\n"
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+                if event.get("state") in ("finished", "error"):
+                    return
+        finally:
+            event_hub.unsubscribe(job_id, events)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+def file_response(request: Request, path, media_type, filename=None):
+    """
+    Description: Serve a file with an ETag, answering If-None-Match with 304 Not Modified.
+        FileResponse streams the file from disk and handles Range and If-Range requests,
+        so an interrupted download can be resumed where it stopped.
+    Input:
+        request: Request, the download request.
+        path: str, the path to the file.
+        media_type: str, the content type of the file.
+        filename: str, the name to download the file as, or None to display it inline.
+    Return:
+        response: FileResponse, or a 304 Response if the client already has this version of the file.
+    """
+    stat = os.stat(path)
+    # Cheap strong validator: a rewritten file gets a new mtime or size, no need to hash gigabytes
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FileResponse(
+        path=path, media_type=media_type, filename=filename, stat_result=stat, headers={"ETag": etag}
+    )
+
+
+def job_manifest(job_id: str):
+    manifest_path = OUTPUT_DIR / job_id / "daisy_output" / f"stages_{job_id}.json"
+    if job_queue is None or job_queue.get(job_id) is None or not manifest_path.exists():
+        raise HTTPException(status_code=404, detail="Job not found or not started")
+    return StageManifest(str(manifest_path))
 
 
 @app.get("/download/{job_id}")
-async def download_result(job_id: str):
-    job_status = jobs.get(job_id) if jobs else None
+async def download_result(job_id: str, request: Request):
+    job_status = job_queue.get(job_id) if job_queue else None
     if job_status is None or job_status.get("status") != "finished":
         raise HTTPException(status_code=404, detail="Job not found or not finished")
 
@@ -143,14 +321,31 @@ async def download_result(job_id: str):
     if not result_path or not os.path.exists(result_path):
         raise HTTPException(status_code=404, detail="Result file not found.")
 
-    return FileResponse(path=result_path, media_type='application/zip', filename=os.path.basename(result_path))
+    return file_response(request, result_path, 'application/zip', os.path.basename(result_path))
+
+
+@app.get("/download/{job_id}/chapters")
+async def list_chapters(job_id: str):
+    # Chapters are listed as soon as their audio is merged, before the whole book is packaged
+    manifest = job_manifest(job_id)
+    chapters = sorted(int(stage.split("_")[1]) for stage in manifest.stages if stage.startswith("merge_"))
+    return {"job_id": job_id, "chapters": chapters}
+
+
+@app.get("/download/{job_id}/chapters/{chapter_idx}")
+async def download_chapter(job_id: str, chapter_idx: int, request: Request):
+    merged = job_manifest(job_id).get(f"merge_{chapter_idx}")
+    if merged is None:
+        raise HTTPException(status_code=404, detail="Chapter not merged yet")
+
+    _, audio_path = merged
+    if not os.path.exists(audio_path):
+        raise HTTPException(status_code=404, detail="Chapter audio file not found.")
+    media_type = mimetypes.guess_type(audio_path)[0] or "application/octet-stream"
+    return file_response(request, audio_path, media_type)
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    # Initialize multiprocessing manager here (safe for Windows)
-    manager = multiprocessing.Manager()
-    jobs = manager.dict()
-
     uvicorn.run(app, host="0.0.0.0", port=4567, workers=1)
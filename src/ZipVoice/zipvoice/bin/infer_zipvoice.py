@@ -54,8 +54,10 @@ import datetime as dt
 import json
 import logging
 import os
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import numpy as np
 import safetensors.torch
@@ -83,6 +85,13 @@ MODEL_DIR = {
     "zipvoice_distill": "zipvoice_distill",
 }
 
+# Prompts loaded by load_prompt(), shared by all generation calls in the process.
+# Pipeline stages call load_prompt() from several threads, so the cache is
+# only accessed with _prompt_cache_lock held.
+PROMPT_CACHE_SIZE = 8
+_prompt_cache = OrderedDict()
+_prompt_cache_lock = threading.Lock()
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -236,6 +245,14 @@ def get_parser():
         help="Random seed",
     )
 
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of sentences of --test-list sharing a prompt "
+        "that are generated in one batch",
+    )
+
     return parser
 
 
@@ -253,8 +270,88 @@ def get_vocoder(vocos_local_path: Optional[str] = None):
     return vocoder
 
 
-def generate_sentence(
-    save_path: str,
+def load_prompt(
+    prompt_text: str,
+    prompt_wav: str,
+    tokenizer: EmiliaTokenizer,
+    feature_extractor: VocosFbank,
+    device: torch.device,
+    target_rms: float = 0.1,
+    feat_scale: float = 0.1,
+    sampling_rate: int = 24000,
+):
+    """
+    Load the prompt wav, normalize its volume, extract its features
+        and tokenize its transcription.
+
+    The result is cached per process, keyed by the wav path and
+        modification time, the transcription, the sampling rate and the
+        other settings the result depends on, so a prompt reused for every
+        sentence is read and analysed only once. It is safe to call from
+        several threads.
+
+    Args:
+        prompt_text (str): Transcription of the prompt wav.
+        prompt_wav (str): Path to the prompt wav file.
+        Other arguments are the same as in `generate_wav`.
+    Returns:
+        prompt_tokens (List[List[int]]): Token ids of the transcription.
+        prompt_features (torch.Tensor): Scaled prompt features on `device`,
+            shape (1, num_frames, feat_dim).
+        prompt_features_lens (torch.Tensor): Shape (1,).
+        prompt_rms (torch.Tensor): RMS of the prompt wav before normalization.
+    The returned objects are shared with the cache and must not be modified.
+    """
+    key = (
+        os.path.abspath(prompt_wav),
+        os.path.getmtime(prompt_wav),
+        prompt_text,
+        sampling_rate,
+        target_rms,
+        feat_scale,
+        str(device),
+        tokenizer,
+    )
+    with _prompt_cache_lock:
+        if key in _prompt_cache:
+            _prompt_cache.move_to_end(key)
+            return _prompt_cache[key]
+
+    # Loaded without the lock: two threads missing the same prompt both load
+    # it, and the cache keeps one of the identical results
+
+    prompt_tokens = tokenizer.texts_to_token_ids([prompt_text])
+
+    # Load and preprocess prompt wav
+    prompt_wav, prompt_sampling_rate = torchaudio.load(prompt_wav)
+
+    if prompt_sampling_rate != sampling_rate:
+        resampler = torchaudio.transforms.Resample(
+            orig_freq=prompt_sampling_rate, new_freq=sampling_rate
+        )
+        prompt_wav = resampler(prompt_wav)
+
+    prompt_rms = torch.sqrt(torch.mean(torch.square(prompt_wav)))
+    if prompt_rms < target_rms:
+        prompt_wav = prompt_wav * target_rms / prompt_rms
+
+    # Extract features from prompt wav
+    prompt_features = feature_extractor.extract(
+        prompt_wav, sampling_rate=sampling_rate
+    ).to(device)
+
+    prompt_features = prompt_features.unsqueeze(0) * feat_scale
+    prompt_features_lens = torch.tensor([prompt_features.size(1)], device=device)
+
+    prompt = (prompt_tokens, prompt_features, prompt_features_lens, prompt_rms)
+    with _prompt_cache_lock:
+        _prompt_cache[key] = prompt
+        if len(_prompt_cache) > PROMPT_CACHE_SIZE:
+            _prompt_cache.popitem(last=False)
+    return prompt
+
+
+def generate_wav(
     prompt_text: str,
     prompt_wav: str,
     text: str,
@@ -273,10 +370,9 @@ def generate_sentence(
 ):
     """
     Generate waveform of a text based on a given prompt
-        waveform and its transcription.
+        waveform and its transcription, and return it in memory.
 
     Args:
-        save_path (str): Path to save the generated wav.
         prompt_text (str): Transcription of the prompt wav.
         prompt_wav (str): Path to the prompt wav file.
         text (str): Text to be synthesized into a waveform.
@@ -298,33 +394,24 @@ def generate_sentence(
         sampling_rate (int, optional): Sampling rate for the waveform.
             Defaults to 24000.
     Returns:
+        wav (torch.Tensor): The generated waveform, shape (1, num_samples),
+            on the given device.
         metrics (dict): Dictionary containing time and real-time
             factor metrics for processing.
     """
     # Convert text to tokens
     tokens = tokenizer.texts_to_token_ids([text])
-    prompt_tokens = tokenizer.texts_to_token_ids([prompt_text])
-
-    # Load and preprocess prompt wav
-    prompt_wav, prompt_sampling_rate = torchaudio.load(prompt_wav)
-
-    if prompt_sampling_rate != sampling_rate:
-        resampler = torchaudio.transforms.Resample(
-            orig_freq=prompt_sampling_rate, new_freq=sampling_rate
-        )
-        prompt_wav = resampler(prompt_wav)
 
-    prompt_rms = torch.sqrt(torch.mean(torch.square(prompt_wav)))
-    if prompt_rms < target_rms:
-        prompt_wav = prompt_wav * target_rms / prompt_rms
-
-    # Extract features from prompt wav
-    prompt_features = feature_extractor.extract(
-        prompt_wav, sampling_rate=sampling_rate
-    ).to(device)
-
-    prompt_features = prompt_features.unsqueeze(0) * feat_scale
-    prompt_features_lens = torch.tensor([prompt_features.size(1)], device=device)
+    prompt_tokens, prompt_features, prompt_features_lens, prompt_rms = load_prompt(
+        prompt_text=prompt_text,
+        prompt_wav=prompt_wav,
+        tokenizer=tokenizer,
+        feature_extractor=feature_extractor,
+        device=device,
+        target_rms=target_rms,
+        feat_scale=feat_scale,
+        sampling_rate=sampling_rate,
+    )
 
     # Start timing
     start_t = dt.datetime.now()
@@ -375,11 +462,264 @@ def generate_sentence(
     # Adjust wav volume if necessary
     if prompt_rms < target_rms:
         wav = wav * prompt_rms / target_rms
+
+    return wav, metrics
+
+
+def generate_sentence(
+    save_path: str,
+    prompt_text: str,
+    prompt_wav: str,
+    text: str,
+    model: torch.nn.Module,
+    vocoder: torch.nn.Module,
+    tokenizer: EmiliaTokenizer,
+    feature_extractor: VocosFbank,
+    device: torch.device,
+    num_step: int = 16,
+    guidance_scale: float = 1.0,
+    speed: float = 1.0,
+    t_shift: float = 0.5,
+    target_rms: float = 0.1,
+    feat_scale: float = 0.1,
+    sampling_rate: int = 24000,
+):
+    """
+    Generate waveform of a text based on a given prompt
+        waveform and its transcription, and save it to `save_path`.
+
+    Args:
+        save_path (str): Path to save the generated wav.
+        Other arguments are the same as in `generate_wav`.
+    Returns:
+        metrics (dict): Dictionary containing time and real-time
+            factor metrics for processing.
+    """
+    wav, metrics = generate_wav(
+        prompt_text=prompt_text,
+        prompt_wav=prompt_wav,
+        text=text,
+        model=model,
+        vocoder=vocoder,
+        tokenizer=tokenizer,
+        feature_extractor=feature_extractor,
+        device=device,
+        num_step=num_step,
+        guidance_scale=guidance_scale,
+        speed=speed,
+        t_shift=t_shift,
+        target_rms=target_rms,
+        feat_scale=feat_scale,
+        sampling_rate=sampling_rate,
+    )
     torchaudio.save(save_path, wav.cpu(), sample_rate=sampling_rate)
 
     return metrics
 
 
+def sample_batch(
+    prompt_text: str,
+    prompt_wav: str,
+    texts: List[str],
+    model: torch.nn.Module,
+    tokenizer: EmiliaTokenizer,
+    feature_extractor: VocosFbank,
+    device: torch.device,
+    num_step: int = 16,
+    guidance_scale: float = 1.0,
+    speed: float = 1.0,
+    t_shift: float = 0.5,
+    target_rms: float = 0.1,
+    feat_scale: float = 0.1,
+    sampling_rate: int = 24000,
+    tokens: Optional[List[List[int]]] = None,
+):
+    """
+    Generate the features of several texts sharing one prompt with a single
+        `model.sample` call, the first half of `generate_batch`.
+
+    Args:
+        Same as in `generate_batch`.
+    Returns:
+        pred_features (torch.Tensor): Predicted features of shape (B, C, T),
+            scaled for the vocoder, padded to the longest item.
+        pred_features_lens (torch.Tensor): Number of frames of each item, (B,).
+        prompt_rms (float): RMS of the prompt wav, before normalization.
+        t_no_vocoder (float): Time spent in `model.sample`, in seconds.
+    """
+    batch_size = len(texts)
+    if tokens is None:
+        tokens = tokenizer.texts_to_token_ids(texts)
+
+    prompt_tokens, prompt_features, prompt_features_lens, prompt_rms = load_prompt(
+        prompt_text=prompt_text,
+        prompt_wav=prompt_wav,
+        tokenizer=tokenizer,
+        feature_extractor=feature_extractor,
+        device=device,
+        target_rms=target_rms,
+        feat_scale=feat_scale,
+        sampling_rate=sampling_rate,
+    )
+    prompt_tokens = prompt_tokens * batch_size
+    prompt_features = prompt_features.repeat(batch_size, 1, 1)
+    prompt_features_lens = prompt_features_lens.repeat(batch_size)
+
+    # Start timing
+    start_t = dt.datetime.now()
+
+    # Generate features
+    (
+        pred_features,
+        pred_features_lens,
+        pred_prompt_features,
+        pred_prompt_features_lens,
+    ) = model.sample(
+        tokens=tokens,
+        prompt_tokens=prompt_tokens,
+        prompt_features=prompt_features,
+        prompt_features_lens=prompt_features_lens,
+        speed=speed,
+        t_shift=t_shift,
+        duration="predict",
+        num_step=num_step,
+        guidance_scale=guidance_scale,
+    )
+
+    # Postprocess predicted features
+    pred_features = pred_features.permute(0, 2, 1) / feat_scale  # (B, C, T)
+
+    t_no_vocoder = (dt.datetime.now() - start_t).total_seconds()
+    return pred_features, pred_features_lens, prompt_rms, t_no_vocoder
+
+
+def decode_batch(
+    pred_features: torch.Tensor,
+    pred_features_lens: torch.Tensor,
+    prompt_rms: float,
+    t_no_vocoder: float,
+    vocoder: torch.nn.Module,
+    target_rms: float = 0.1,
+    sampling_rate: int = 24000,
+):
+    """
+    Decode the features returned by `sample_batch`, the second half of
+        `generate_batch`.
+
+    Each item is decoded at its own length. Padding frames are not
+        silence for the vocoder, and its receptive field would carry them
+        into the end of the shorter items, making their audio depend on
+        the other items of the batch.
+
+    Args:
+        pred_features, pred_features_lens, prompt_rms, t_no_vocoder: The
+            outputs of `sample_batch`.
+        Other arguments are the same as in `generate_batch`.
+    Returns:
+        Same as `generate_batch`.
+    """
+    batch_size = pred_features.size(0)
+
+    # Start vocoder processing
+    start_vocoder_t = dt.datetime.now()
+    wavs = [
+        vocoder.decode(pred_features[i : i + 1, :, : int(pred_features_lens[i])])
+        .squeeze(1)
+        .clamp(-1, 1)  # (1, S)
+        for i in range(batch_size)
+    ]
+
+    # Calculate processing times and real-time factors
+    t_vocoder = (dt.datetime.now() - start_vocoder_t).total_seconds()
+    t = t_no_vocoder + t_vocoder
+    wav_seconds = sum(w.shape[-1] for w in wavs) / sampling_rate
+    rtf = t / wav_seconds
+    rtf_no_vocoder = t_no_vocoder / wav_seconds
+    rtf_vocoder = t_vocoder / wav_seconds
+    metrics = {
+        "t": t,
+        "t_no_vocoder": t_no_vocoder,
+        "t_vocoder": t_vocoder,
+        "wav_seconds": wav_seconds,
+        "rtf": rtf,
+        "rtf_no_vocoder": rtf_no_vocoder,
+        "rtf_vocoder": rtf_vocoder,
+    }
+
+    # Adjust wav volume if necessary
+    if prompt_rms < target_rms:
+        wavs = [w * prompt_rms / target_rms for w in wavs]
+
+    return wavs, metrics
+
+
+def generate_batch(
+    prompt_text: str,
+    prompt_wav: str,
+    texts: List[str],
+    model: torch.nn.Module,
+    vocoder: torch.nn.Module,
+    tokenizer: EmiliaTokenizer,
+    feature_extractor: VocosFbank,
+    device: torch.device,
+    num_step: int = 16,
+    guidance_scale: float = 1.0,
+    speed: float = 1.0,
+    t_shift: float = 0.5,
+    target_rms: float = 0.1,
+    feat_scale: float = 0.1,
+    sampling_rate: int = 24000,
+    tokens: Optional[List[List[int]]] = None,
+):
+    """
+    Generate waveforms of several texts sharing one prompt with a single
+        `model.sample` call, then decode each of them with the vocoder.
+
+    The prompt is repeated along the batch dimension and items are padded
+        to the longest predicted length (the padding mask is built inside
+        `model.sample` from the predicted feature lengths). Each item is then
+        decoded at its own length by `decode_batch`, so no padding frame
+        reaches the vocoder.
+
+    Args:
+        texts (List[str]): Texts to be synthesized into waveforms.
+        tokens (List[List[int]], optional): Token ids of `texts`, if the caller
+            already has them. Computed from `texts` if None.
+        Other arguments are the same as in `generate_wav`.
+    Returns:
+        wavs (List[torch.Tensor]): One waveform of shape (1, num_samples)
+            per text, in the order of `texts`, on the given device.
+        metrics (dict): Dictionary containing time and real-time
+            factor metrics for the whole batch.
+    """
+    pred_features, pred_features_lens, prompt_rms, t_no_vocoder = sample_batch(
+        prompt_text=prompt_text,
+        prompt_wav=prompt_wav,
+        texts=texts,
+        model=model,
+        tokenizer=tokenizer,
+        feature_extractor=feature_extractor,
+        device=device,
+        num_step=num_step,
+        guidance_scale=guidance_scale,
+        speed=speed,
+        t_shift=t_shift,
+        target_rms=target_rms,
+        feat_scale=feat_scale,
+        sampling_rate=sampling_rate,
+        tokens=tokens,
+    )
+    return decode_batch(
+        pred_features=pred_features,
+        pred_features_lens=pred_features_lens,
+        prompt_rms=prompt_rms,
+        t_no_vocoder=t_no_vocoder,
+        vocoder=vocoder,
+        target_rms=target_rms,
+        sampling_rate=sampling_rate,
+    )
+
+
 def generate_list(
     res_dir: str,
     test_list: str,
@@ -395,6 +735,7 @@ def generate_list(
     target_rms: float = 0.1,
     feat_scale: float = 0.1,
     sampling_rate: int = 24000,
+    batch_size: int = 1,
 ):
     total_t = []
     total_t_no_vocoder = []
@@ -403,15 +744,27 @@ def generate_list(
 
     with open(test_list, "r", encoding="utf-8") as fr:
         lines = fr.readlines()
-
-    for i, line in enumerate(lines):
-        wav_name, prompt_text, prompt_wav, text = line.strip().split("\t")
-        save_path = f"{res_dir}/{wav_name}.wav"
-        metrics = generate_sentence(
-            save_path=save_path,
+    items = [line.strip().split("\t") for line in lines]
+
+    # Consecutive lines with the same prompt are generated together,
+    # at most batch_size at a time.
+    batches = []
+    for item in items:
+        if (
+            batches
+            and len(batches[-1]) < batch_size
+            and batches[-1][0][1:3] == item[1:3]
+        ):
+            batches[-1].append(item)
+        else:
+            batches.append([item])
+
+    for i, batch in enumerate(batches):
+        _, prompt_text, prompt_wav, _ = batch[0]
+        wavs, metrics = generate_batch(
             prompt_text=prompt_text,
             prompt_wav=prompt_wav,
-            text=text,
+            texts=[text for _, _, _, text in batch],
             model=model,
             vocoder=vocoder,
             tokenizer=tokenizer,
@@ -425,7 +778,10 @@ def generate_list(
             feat_scale=feat_scale,
             sampling_rate=sampling_rate,
         )
-        logging.info(f"[Sentence: {i}] RTF: {metrics['rtf']:.4f}")
+        for (wav_name, _, _, _), wav in zip(batch, wavs):
+            save_path = f"{res_dir}/{wav_name}.wav"
+            torchaudio.save(save_path, wav.cpu(), sample_rate=sampling_rate)
+        logging.info(f"[Batch: {i}, size: {len(batch)}] RTF: {metrics['rtf']:.4f}")
         total_t.append(metrics["t"])
         total_t_no_vocoder.append(metrics["t_no_vocoder"])
         total_t_vocoder.append(metrics["t_vocoder"])
@@ -442,15 +798,22 @@ def generate_list(
     )
 
 
-@torch.inference_mode()
-def main():
-    parser = get_parser()
-    args = parser.parse_args()
-
-    params = AttributeDict()
-    params.update(vars(args))
-    fix_random_seed(params.seed)
+def load_model(params: AttributeDict):
+    """
+    Build the tokenizer, model, vocoder and feature extractor described by
+        `params`, and move them to the available device.
 
+    Args:
+        params (AttributeDict): Inference parameters, as produced by
+            `get_parser()`. `params.num_step` and `params.guidance_scale`
+            are filled with model-specific defaults if they are None,
+            and `params.device` and `params.sampling_rate` are set.
+    Returns:
+        model (torch.nn.Module): The model used for generation.
+        vocoder (torch.nn.Module): The vocoder.
+        tokenizer: The tokenizer used to convert text to tokens.
+        feature_extractor (VocosFbank): The feature extractor.
+    """
     model_defaults = {
         "zipvoice": {
             "num_step": 16,
@@ -469,13 +832,6 @@ def main():
             setattr(params, param, value)
             logging.info(f"Setting {param} to default value: {value}")
 
-    assert (params.test_list is not None) ^ (
-        (params.prompt_wav and params.prompt_text and params.text) is not None
-    ), (
-        "For inference, please provide prompts and text with either '--test-list'"
-        " or '--prompt-wav, --prompt-text and --text'."
-    )
-
     if params.model_dir is not None:
         params.model_dir = Path(params.model_dir)
         if not params.model_dir.is_dir():
@@ -563,6 +919,27 @@ def main():
         )
     params.sampling_rate = model_config["feature"]["sampling_rate"]
 
+    return model, vocoder, tokenizer, feature_extractor
+
+
+@torch.inference_mode()
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    params = AttributeDict()
+    params.update(vars(args))
+    fix_random_seed(params.seed)
+
+    assert (params.test_list is not None) ^ (
+        (params.prompt_wav and params.prompt_text and params.text) is not None
+    ), (
+        "For inference, please provide prompts and text with either '--test-list'"
+        " or '--prompt-wav, --prompt-text and --text'."
+    )
+
+    model, vocoder, tokenizer, feature_extractor = load_model(params)
+
     logging.info("Start generating...")
     if params.test_list:
         os.makedirs(params.res_dir, exist_ok=True)
@@ -581,6 +958,7 @@ def main():
             target_rms=params.target_rms,
             feat_scale=params.feat_scale,
             sampling_rate=params.sampling_rate,
+            batch_size=params.batch_size,
         )
     else:
         generate_sentence(
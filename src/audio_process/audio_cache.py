@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import shutil
+import unicodedata
+from src.audio_process.wav_writer import write_wav
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Eviction frees the cache down to this fraction of max_bytes, so that the full scan it does
+# runs once per many stored chunks instead of on every chunk once the cache is full
+EVICT_TARGET = 0.9
+
+
+class AudioCache:
+    def __init__(self, cache_dir="data/cache/audio", max_bytes=10 * 1024 ** 3):
+        """
+        Description: A content-addressed cache of synthesized chunk wavs on local disk,
+            evicting the least recently used files when it grows above max_bytes.
+        Input:
+            cache_dir: str, the directory of the cache.
+            max_bytes: int, the maximum total size of the cached files.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(path) for path in self._files())
+
+    @staticmethod
+    def make_key(text, **settings):
+        """
+        Description: Build the cache key of a chunk.
+        Input:
+            text: str, the text of the chunk, normalized before hashing.
+            settings: everything else the audio depends on (prompt id, checkpoint hash, num_step, ...).
+        Return:
+            key: str, the hex SHA-256 of the normalized text and the settings.
+        """
+        text = unicodedata.normalize("NFC", " ".join(text.split()))
+        payload = json.dumps({"text": text, **settings}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.wav")
+
+    def _files(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".wav"):
+                    yield os.path.join(root, name)
+
+    def lookup(self, key, dest=None):
+        """
+        Description: Find the cached wav of a key, and mark it as recently used.
+            Another worker sharing the cache may evict the file at any time, so a caller that reads it
+            later should pass dest: the file is hard-linked (or copied) there, and stays readable.
+        Input:
+            key: str, the cache key.
+            dest: str, where to link the cached wav, or None to use it in place.
+        Return:
+            path: str, the path to the cached wav (dest if given), or None if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            # Mark as recently used
+            os.utime(path)
+            if dest is not None:
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                try:
+                    os.link(path, dest)
+                except FileNotFoundError:
+                    raise  # evicted in the meantime, a miss
+                except OSError:
+                    # e.g. the cache is on another file system
+                    shutil.copyfile(path, dest)
+                path = dest
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def store_frames(self, key, frames, sample_rate, channels=1):
+        """
+        Description: Add synthesized audio to the cache, then evict old entries if the cache is too big.
+        Input:
+            key: str, the cache key.
+            frames: bytes, 16-bit PCM frames.
+            sample_rate: int, the sample rate of the frames.
+            channels: int, the number of channels.
+        """
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several workers may share the cache, never expose a partial file
+        tmp_path = f"{path}.{os.getpid()}.part"
+        write_wav(tmp_path, frames, sample_rate, channels)
+        os.replace(tmp_path, path)
+        self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Description: Delete the least recently used files until the cache fits in EVICT_TARGET * max_bytes.
+        """
+        target_bytes = self.max_bytes * EVICT_TARGET
+        entries = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        self.total_bytes = sum(size for _, size, _ in entries)
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if self.total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+            removed += 1
+        logger.info(f"Evicted {removed} files from the audio cache, {self.total_bytes} bytes left")
+
+    def stats(self):
+        """
+        Description: Get the hit and miss counters of the cache.
+        Return:
+            stats: dict, the hits, misses and current size in bytes.
+        """
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
+
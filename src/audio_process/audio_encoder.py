@@ -0,0 +1,87 @@
+import os
+import subprocess
+import wave
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# ffmpeg output options of each compressed format.
+# The mp3 muxer writes a Xing/LAME header with the encoder delay and padding, and Ogg Opus
+# stores its pre-skip and end trimming, so decoders drop them and the audio starts and ends
+# on the same samples as the wav: the sync markers computed on the wav stay exact.
+# The container duration (ffprobe format=duration) of an mp3 still counts the delay and
+# padding, about 66 ms at 24 kHz, so the check below counts decoded samples instead.
+AUDIO_FORMATS = {
+    "mp3": ["-c:a", "libmp3lame", "-f", "mp3"],
+    "opus": ["-c:a", "libopus", "-application", "voip", "-f", "ogg"],
+}
+
+# Allowed difference between the durations of the wav and of the decoded file, in seconds.
+# With ffmpeg 7.0 the decoded audio starts on the first sample of the wav, and a 64 kbps
+# mp3 keeps at most 2 ms of padding at its end, even for a one-hour chapter.
+DURATION_TOLERANCE = 0.005
+
+
+def encode_audio(wav_path, audio_format="mp3", bitrate="64k", remove_wav=True):
+    """
+    Description: Encode a wav file to a compressed format with ffmpeg, then decode it to check that the duration
+        did not change. A decoder that did not drop the encoder delay would add it at the start, and shift every
+        sync marker computed on the wav: if the durations differ by more than DURATION_TOLERANCE, the encoded
+        file is deleted, the wav is kept and a RuntimeError is raised.
+    Input:
+        wav_path: str, the path to the wav file.
+        audio_format: str, "mp3" or "opus".
+        bitrate: str, the constant bitrate of the output, e.g. "64k".
+        remove_wav: bool, delete the wav file once it is encoded.
+    Return:
+        output_path: str, the path to the encoded file, next to the wav file.
+    """
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unsupported audio format: {audio_format}, expected one of {list(AUDIO_FORMATS)}")
+    output_path = f"{os.path.splitext(wav_path)[0]}.{audio_format}"
+
+    # Write then rename, so an existing output is always complete
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-y", "-loglevel", "error", "-i", wav_path,
+         *AUDIO_FORMATS[audio_format], "-b:a", bitrate, f"{output_path}.part"],
+        check=True,
+    )
+    os.replace(f"{output_path}.part", output_path)
+
+    with wave.open(wav_path, "rb") as wav:
+        sample_rate, channels = wav.getframerate(), wav.getnchannels()
+        wav_duration = wav.getnframes() / sample_rate
+    encoded_duration = get_decoded_samples(output_path, sample_rate, channels) / sample_rate
+    if abs(encoded_duration - wav_duration) > DURATION_TOLERANCE:
+        os.remove(output_path)
+        raise RuntimeError(f"{output_path} lasted {encoded_duration:.3f}s but {wav_path} lasts {wav_duration:.3f}s, "
+                           f"the sync markers would be shifted")
+
+    if remove_wav:
+        os.remove(wav_path)
+    return output_path
+
+
+def get_decoded_samples(audio_path, sample_rate, channels=1):
+    """
+    Description: Count the samples a decoder plays from an audio file, by decoding it with ffmpeg.
+        The encoder delay and padding recorded in the file are dropped, as players do.
+    Input:
+        audio_path: str, the path to the audio file.
+        sample_rate: int, the sample rate to decode at, the one of the source wav so no resampling happens.
+        channels: int, the number of channels to decode.
+    Return:
+        num_samples: int, the number of decoded samples per channel.
+    """
+    process = subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", audio_path,
+         "-f", "s16le", "-ac", str(channels), "-ar", str(sample_rate), "-"],
+        stdout=subprocess.PIPE,
+    )
+    # Count the bytes as they come, a chapter decoded to PCM can take hundreds of MB
+    num_bytes = 0
+    for block in iter(lambda: process.stdout.read(1 << 20), b""):
+        num_bytes += len(block)
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return num_bytes // (2 * channels)
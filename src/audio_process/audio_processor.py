@@ -1,169 +1,410 @@
 import glob
 import gc
 import torch
-import sys
 import os
-from pydub import AudioSegment
+import shutil
+import threading
+from itertools import groupby
 import json
 from tqdm import tqdm
 from src.utils import read_txt_file, ms_to_anemone_time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-# 1. Add ZipVoice repo to path
-sys.path.append("src/ZipVoice")  # change if cloned elsewhere
-
-# 2. Import the zipvoice main
-from zipvoice.bin import infer_zipvoice
+from src.audio_process.tts_engine import get_tts_engine
+from src.audio_process.audio_cache import AudioCache
+from src.audio_process.wav_writer import WavWriter, write_wav
+from src.audio_process.audio_encoder import AUDIO_FORMATS, encode_audio
+from src.pipeline import Pipeline, Stage
 from src.logging_config import setup_logger
 
 logger = setup_logger(__name__)
 
+# Pause between two sentences of a chapter
+PAUSE_MS = 800
+# Workers of each stage of the book pipeline, see create_audio_for_book
+DEFAULT_STAGE_WORKERS = {"prepare": 2, "acoustic": 1, "vocoder": 1, "merge": 1, "encode": 2}
+
+
+class TtsProgress:
+    def __init__(self, status_dict, chapter_chunks, total_chapters):
+        """
+        Description: Count the chunks of a book as they are synthesized, and report
+            the chapter, chunk, RTF and ETA to the status dict.
+        Input:
+            status_dict: dict, the status of the job, or None.
+            chapter_chunks: dict, the number of chunks of each chapter left to synthesize.
+            total_chapters: int, the number of chapters of the book.
+        """
+        self.status_dict = status_dict
+        self.chapter_chunks = chapter_chunks
+        self.total_chapters = total_chapters
+        self.total_chunks = sum(chapter_chunks.values())
+        self.done = 0
+        self.synthesized = 0
+        self.tts_seconds = 0.0
+        self.chapter = None
+        self.chapter_done = {}
+        # Called from the threads of several pipeline stages
+        self.lock = threading.Lock()
+
+    def add(self, chapter_id, num_chunks, metrics=None):
+        """
+        Description: Record finished chunks.
+        Input:
+            chapter_id: int, the chapter of the chunks.
+            num_chunks: int, the number of chunks finished.
+            metrics: dict, the metrics of the batch if they were synthesized, None if they were reused.
+        """
+        with self.lock:
+            self.done += num_chunks
+            self.chapter_done[chapter_id] = self.chapter_done.get(chapter_id, 0) + num_chunks
+            if metrics is not None:
+                self.synthesized += num_chunks
+                self.tts_seconds += metrics["t"]
+            if self.status_dict is None:
+                return
+
+            if chapter_id != self.chapter:
+                self.chapter = chapter_id
+                self.status_dict["status"] = f"Running TTS for chapter {chapter_id}/{self.total_chapters}"
+            eta = None
+            if self.synthesized:
+                eta = round(self.tts_seconds / self.synthesized * (self.total_chunks - self.done))
+            self.status_dict.update(
+                stage="tts",
+                chapter=chapter_id,
+                chunk=self.chapter_done[chapter_id],
+                chunks=self.chapter_chunks[chapter_id],
+                rtf=round(metrics["rtf"], 4) if metrics is not None else None,
+                eta=eta,
+            )
+
+
+class ChapterMerger:
+    def __init__(self, chapter_id, wav_names, output_dir, sampling_rate, audio_cache=None, keep_chunk_wavs=False):
+        """
+        Description: Merge the chunks of a chapter into a single wav file as they come out of the TTS engine.
+            Chunks may arrive out of order, they are buffered until the next one in order is available.
+            The sync markers are computed from the number of frames written.
+        Input:
+            chapter_id: int, the index of the chapter.
+            wav_names: list, the names of the chunks in order, the first one is the chapter title.
+            output_dir: str, the directory of the chapter audio.
+            sampling_rate: int, the sample rate of the chunks.
+            audio_cache: AudioCache, where to store the synthesized chunks, or None.
+            keep_chunk_wavs: bool, also save the wav of every chunk in output_dir, for debugging.
+        """
+        self.chapter_id = chapter_id
+        self.wav_names = wav_names
+        self.output_dir = output_dir
+        self.sampling_rate = sampling_rate
+        self.audio_cache = audio_cache
+        self.keep_chunk_wavs = keep_chunk_wavs
+        self.merge_audio_file = f"{output_dir}/full_{chapter_id}.wav"
+        self.writer = WavWriter(self.merge_audio_file, sampling_rate)
+        self.audio_sync_lst = []
+        self.pending = {}
+        self.next_idx = 0
+
+    @staticmethod
+    def wav_path(output_dir, wav_name):
+        return f"{output_dir}/{wav_name}.wav"
+
+    def chunk_wav_path(self, idx):
+        return self.wav_path(self.output_dir, self.wav_names[idx])
+
+    @property
+    def done(self):
+        return self.next_idx == len(self.wav_names)
+
+    def add(self, idx, audio, key=None):
+        """
+        Description: Add a chunk, and write every chunk that is now in order.
+        Input:
+            idx: int, the index of the chunk in wav_names.
+            audio: torch.Tensor, the waveform of the chunk, or str, the path to its cached wav,
+                removed once merged if it is the chunk wav path and keep_chunk_wavs is False.
+            key: str, the audio cache key to store a synthesized chunk under, or None.
+        """
+        self.pending[idx] = (audio, key)
+        while self.next_idx in self.pending:
+            self._write(self.next_idx, *self.pending.pop(self.next_idx))
+            self.next_idx += 1
+
+    def _write(self, idx, audio, key):
+        if idx == 0:
+            self.audio_sync_lst.append({"id": f"c{self.chapter_id}_title", "time": "0:00"})
+        else:
+            # save audio and duration to a json to sync with text
+            self.audio_sync_lst.append({"id": f"c{self.chapter_id}_c{idx - 1}",
+                                        "time": ms_to_anemone_time(self.writer.position_ms)})
+
+        chunk_wav = self.chunk_wav_path(idx)
+        if isinstance(audio, str):
+            self.writer.write_file(audio)
+            if audio == chunk_wav:
+                # A cache hit linked into the chapter directory by the prepare stage
+                if not self.keep_chunk_wavs:
+                    os.remove(audio)
+            elif self.keep_chunk_wavs:
+                shutil.copyfile(audio, chunk_wav)
+        else:
+            frames = _to_pcm16(audio)
+            self.writer.write_frames(frames)
+            if key is not None and self.audio_cache is not None:
+                self.audio_cache.store_frames(key, frames, self.sampling_rate)
+            if self.keep_chunk_wavs:
+                write_wav(chunk_wav, frames, self.sampling_rate)
+
+        # Add pause between sentences, not after the title nor the last one
+        if 0 < idx < len(self.wav_names) - 1:
+            self.writer.write_silence(PAUSE_MS)
+
+    def close(self):
+        """
+        Description: Finish the chapter wav and save the sync markers.
+        Return:
+            json_file: str, the path to the json file containing the sync information.
+            merge_audio_file: str, the path to the merged audio file.
+        """
+        self.writer.close()
+        json_file = f"{self.output_dir}/sync_{self.chapter_id}.json"
+        with open(json_file, "w") as f:
+            json.dump({"markers": self.audio_sync_lst}, f, ensure_ascii=False, indent=2)
+        logger.info(f"\nFinish Merge audio of {self.chapter_id}")
+        return json_file, self.merge_audio_file
+
+    def abort(self):
+        """
+        Description: Drop the partial chapter wav.
+        """
+        self.writer.abort()
+
 
 class AudioProcessor:
-    def __init__(self, audio_output_dir, wav_file_path, wav_text_path, model_dir="src/model", checkpoint_dir="iter-525000-avg-2.pt"):
+    def __init__(self, audio_output_dir, wav_file_path, wav_text_path, model_dir="src/model", checkpoint_dir="iter-525000-avg-2.pt",
+                 audio_cache_dir="data/cache/audio", audio_cache_size=10 * 1024 ** 3, keep_chunk_wavs=False,
+                 audio_format="wav", audio_bitrate="64k", stage_workers=None):
         """
         Description: Initialize the AudioProcessor class.
         Input:
             audio_output_dir: str, the directory to save the audio files.
             checkpoint_dir: str, the path to the TTS model checkpoint.
+            audio_cache_dir: str, the directory of the synthesized chunk cache, None to disable it.
+            audio_cache_size: int, the maximum size of the chunk cache in bytes.
+            keep_chunk_wavs: bool, also save the wav of every chunk in its chapter directory, for debugging.
+            audio_format: str, the format of the chapter audio files, "wav", "mp3" or "opus".
+            audio_bitrate: str, the bitrate of the mp3 or opus files, e.g. "64k".
+            stage_workers: dict, the number of workers of some stages of the book pipeline,
+                overriding DEFAULT_STAGE_WORKERS. The merge stage always has one worker.
         """
         self.wav_file = wav_file_path
         self.wav_text = read_txt_file(wav_text_path)[0]
         self.audio_output_dir = audio_output_dir
         self.model_dir = model_dir
         self.checkpoint_dir = checkpoint_dir
-        
-    
-        
-    def _tts_book(self, tsv_list, result_dir):
-        """
-        Description: Synthesize audio from a tsv file.
-        Input:
-            tsv_list: str, the path to the tsv file.
-            result_dir: str, the directory to save the audio files.
-            model_dir: str, the directory of the TTS model.
-        """
-        custom_args = [
-            "infer_zipvoice",
-            "--model-name", "zipvoice",
-            "--model-dir", self.model_dir,
-            "--checkpoint-name", self.checkpoint_dir,
-            "--tokenizer", "espeak",
-            "--lang", "vi",
-            "--test-list", tsv_list,
-            "--res-dir", result_dir,
-            "--seed", "240899"
-        ]
-        sys.argv = custom_args
-        # clear unused memory
-        torch.cuda.empty_cache()
-        gc.collect()
-        # Run
-        infer_zipvoice.main()
-    
-    def _merge_wav_in_chapter(self, audio_files, chapter_idx):
+        self.keep_chunk_wavs = keep_chunk_wavs
+        if audio_format != "wav" and audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        self.audio_format = audio_format
+        self.audio_bitrate = audio_bitrate
+        self.stage_workers = {**DEFAULT_STAGE_WORKERS, **(stage_workers or {})}
+        if self.stage_workers["merge"] != 1:
+            raise ValueError("The merge stage must have exactly one worker")
+        # Built once per process and reused by every chapter and every job
+        self.tts_engine = get_tts_engine(model_dir=self.model_dir, checkpoint_name=self.checkpoint_dir)
+        self.audio_cache = AudioCache(audio_cache_dir, audio_cache_size) if audio_cache_dir else None
+
+    def _chapter_dir(self, chapter_id):
+        return f"{self.audio_output_dir}/chapter_{chapter_id}"
+
+    def _prepare_stage(self, chapter, progress):
         """
-        Description: Merge all wav files in a chapter into a single wav file.
+        Description: Pipeline stage (CPU): turn the chunks of a chapter into tasks for the next stages.
+            Chunks found in the audio cache become a task that is already synthesized, their wavs linked
+            into the chapter directory so an eviction by another worker cannot remove them before the merge.
+            The others are tokenized (G2P) and bucketed into batches, one task per batch.
+            A first empty task opens the chapter in the merger.
         Input:
-            audio_files: list, a list of audio files to merge.
-            chapter_idx: int, the index of the chapter.
+            chapter: dict, the id of the chapter and its (wav_name, prompt_text, prompt_wav, text) items.
+            progress: TtsProgress, the progress of the book.
         Return:
-            json_file: str, the path to the json file containing the sync information.
-            merge_audio_file: str, the path to the merged audio file.
+            iterator of dict: the tasks, with the chapter, the indices of their chunks, and their audio
+                (None until synthesized), texts, tokens, prompt and cache keys.
         """
+        chapter_id, items = chapter["id"], chapter["items"]
+        yield {"chapter": chapter, "indices": [], "audio": []}
 
-        pause = AudioSegment.silent(duration=800) # 1000 ms = 1 second pause
-        json_sync = {
-                        "markers": []
-                    }
-        audio_sync_lst = [
-            {"id": f"c{chapter_idx}_title", "time": "0:00"},
-        ]
+        # Lines of a tsv normally share one prompt, synthesize each run of lines together
+        for (prompt_text, prompt_wav), group in groupby(enumerate(items), key=lambda x: (x[1][1], x[1][2])):
+            group = [(i, text) for i, (_, _, _, text) in group]
+            keys = [None] * len(group)
+            if self.audio_cache is not None:
+                settings = self.tts_engine.cache_settings((prompt_wav, prompt_text))
+                keys = [AudioCache.make_key(text, **settings) for _, text in group]
+                output_dir = self._chapter_dir(chapter_id)
+                os.makedirs(output_dir, exist_ok=True)
+                hits = [(i, self.audio_cache.lookup(key, ChapterMerger.wav_path(output_dir, items[i][0])))
+                        for (i, _), key in zip(group, keys)]
+                hits = [(i, path) for i, path in hits if path is not None]
+                if hits:
+                    progress.add(chapter_id, len(hits))
+                    yield {"chapter": chapter, "indices": [i for i, _ in hits], "audio": [path for _, path in hits]}
+                hit_indices = {i for i, _ in hits}
+                keys = [key for (i, _), key in zip(group, keys) if i not in hit_indices]
+                group = [(i, text) for i, text in group if i not in hit_indices]
 
-        combined = AudioSegment.from_wav(audio_files[0]) # audio for the title title
+            if not group:
+                continue
+            texts = [text for _, text in group]
+            tokens, batches = self.tts_engine.plan(texts, (prompt_wav, prompt_text))
+            for batch in batches:
+                yield {
+                    "chapter": chapter,
+                    "indices": [group[j][0] for j in batch],
+                    "audio": None,
+                    "texts": [texts[j] for j in batch],
+                    "tokens": [tokens[j] for j in batch],
+                    "keys": [keys[j] for j in batch],
+                    "prompt": (prompt_wav, prompt_text),
+                }
 
-        current_ms = len(combined)  # start after title
+    def _acoustic_stage(self, task):
+        """
+        Description: Pipeline stage (GPU): run the acoustic model on a batch.
+        """
+        if task["audio"] is None:
+            task["features"] = self.tts_engine.sample(task["texts"], task["tokens"], task["prompt"])
+        yield task
 
-        for idx, f in enumerate(audio_files[1:]): # second audio is 1st sentence
-            audio = AudioSegment.from_wav(f)
+    def _vocoder_stage(self, task, progress):
+        """
+        Description: Pipeline stage (GPU): run the vocoder on the features of a batch.
+        """
+        if task["audio"] is None:
+            task["audio"], metrics = self.tts_engine.decode(task.pop("features"))
+            progress.add(task["chapter"]["id"], len(task["indices"]), metrics)
+        yield task
 
-            # save audio and duration to a json to sync with text
-            audio_sync_lst.append({"id": f"c{chapter_idx}_c{idx}", "time": ms_to_anemone_time(current_ms)})
-            combined += audio
-            current_ms += len(audio)
-
-            # Add pause if not last file
-            if idx < len(audio_files) - 2:
-                combined += pause
-                current_ms += len(pause)
-
-        # Save JSON
-        json_sync = {"markers": audio_sync_lst}
-        output_dir = f"{self.audio_output_dir}/chapter_{chapter_idx}"
-        
-        with open(f"{output_dir}/sync_{chapter_idx}.json", "w") as f:
-            json.dump(json_sync, f, ensure_ascii=False, indent=2)
-
-        # Save audio
-        combined.export(f"{output_dir}/full_{chapter_idx}.wav", format="wav")
-        logger.info(f"\nFinish Merge audio of {chapter_idx}") 
-        return f"{output_dir}/sync_{chapter_idx}.json", f"{output_dir}/full_{chapter_idx}.wav"
-        
-    def create_audio_for_book(self, tsv_chapter_list="tsv_dir", status_dict=None):
+    def _merge_stage(self, task, mergers):
+        """
+        Description: Pipeline stage (CPU, one worker): write the chunks into their chapter wav,
+            and pass on the chapters that are complete.
+        Input:
+            task: dict, a task with its audio.
+            mergers: dict, the ChapterMerger of every chapter being merged.
+        Return:
+            iterator of tuple: (chapter_id, json_file, merge_audio_file) for a complete chapter.
+        """
+        chapter = task["chapter"]
+        if chapter["id"] not in mergers:
+            output_dir = self._chapter_dir(chapter["id"])
+            os.makedirs(output_dir, exist_ok=True)
+            mergers[chapter["id"]] = ChapterMerger(chapter["id"], [item[0] for item in chapter["items"]], output_dir,
+                                                   self.tts_engine.sampling_rate, self.audio_cache, self.keep_chunk_wavs)
+        merger = mergers[chapter["id"]]
+        for i, idx in enumerate(task["indices"]):
+            merger.add(idx, task["audio"][i], task["keys"][i] if "keys" in task else None)
+        if merger.done:
+            del mergers[chapter["id"]]
+            yield (chapter["id"], *merger.close())
+
+    def _encode_stage(self, merged, manifest=None, status_dict=None):
+        """
+        Description: Pipeline stage (CPU): encode a merged chapter to the output audio format,
+            and record the chapter in the manifest.
+        Input:
+            merged: tuple, (chapter_id, json_file, merge_audio_file).
+            manifest: StageManifest, the manifest of the job, or None.
+            status_dict: dict, the status of the job, or None.
+        Return:
+            iterator of tuple: (chapter_id, json_file, merge_audio_file), with the encoded audio file.
+        """
+        chapter_id, json_file, merge_audio_file = merged
+        if self.audio_format != "wav":
+            # Run in its own ffmpeg process, so several chapters are encoded in parallel with the TTS
+            merge_audio_file = encode_audio(merge_audio_file, self.audio_format, self.audio_bitrate)
+        if manifest is not None:
+            manifest.mark_done(f"merge_{chapter_id}", [json_file, merge_audio_file])
+        if status_dict is not None:
+            status_dict["merged"] = chapter_id
+        yield chapter_id, json_file, merge_audio_file
+
+    def create_audio_for_book(self, tsv_chapter_list="tsv_dir", status_dict=None, manifest=None):
         """
         Create audio for a book from TSV directories.
-        TTS (GPU) and merging (CPU) are pipelined to run concurrently.
+        The chapters go through a pipeline of stages connected by bounded queues, each with its own workers:
+        prepare (tokenization, CPU) -> acoustic model (GPU) -> vocoder (GPU) -> merge (CPU) -> encode (ffmpeg),
+        so the GPU keeps working while the CPU stages handle the other chunks and chapters.
+        If a StageManifest is given, chapters already merged in a previous run are skipped.
+        The occupancy of every stage is reported in status_dict["stages"].
         """
         total_chapters = len(tsv_chapter_list)
         logger.info(f"Total {total_chapters} chapters to process")
 
-        if status_dict:
+        # Read the chunks of the chapters left to synthesize, and count them for the ETA
+        results = {}
+        chapters = []
+        for tts_dir in tsv_chapter_list:
+            chapter_id = int(os.path.basename(os.path.normpath(tts_dir)).split("_")[-1])
+            merged = manifest.get(f"merge_{chapter_id}") if manifest is not None else None
+            if merged is not None:
+                logger.info(f"Chapter {chapter_id} already merged, skipping")
+                results[chapter_id] = tuple(merged)
+                continue
+            items = []
+            for tts_file in sorted(glob.glob(f"{tts_dir}/*.tsv")):
+                with open(tts_file, "r", encoding="utf-8") as f:
+                    items.extend(line.strip().split("\t") for line in f if line.strip())
+            chapters.append({"id": chapter_id, "items": items})
+        progress = TtsProgress(status_dict, {chapter["id"]: len(chapter["items"]) for chapter in chapters},
+                               total_chapters)
+
+        if status_dict is not None:
             status_dict["total"] = total_chapters
-            status_dict["progress"] = 0
+            status_dict["progress"] = len(results)
 
-        merge_audio_lst = []
-        sync_json_lst = []
+        def encode_and_count(merged):
+            yield from self._encode_stage(merged, manifest, status_dict)
+            if status_dict is not None:
+                with progress.lock:
+                    status_dict["progress"] += 1
+                logger.info(f"Updated progress to {status_dict['progress']}/{status_dict['total']}")
 
         os.makedirs(self.audio_output_dir, exist_ok=True)
-        # ThreadPoolExecutor for CPU merges
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            futures = []
-
-            for i, tts_dir in enumerate(tqdm(tsv_chapter_list, desc="Processing chapters ...")):
-                chapter_id_from_dir = os.path.basename(os.path.normpath(tts_dir)).split("_")[-1]
-
-                if status_dict:
-                    status_dict["status"] = f"Running TTS for chapter {chapter_id_from_dir}/{total_chapters}"
-
-                # Run TTS (GPU) for this chapter
-                for tts_file in sorted(glob.glob(f"{tts_dir}/*.tsv")):
-                    chapter = os.path.basename(tts_file).split(".")[0]
-                    chapter_id = int(chapter.split("_")[-1])
-                    result_dir = f"{self.audio_output_dir}/{chapter}"
-
-                    os.makedirs(result_dir, exist_ok=True)
-                    self._tts_book(tts_file, result_dir)
-
-                logger.info(f"Finished TTS for {chapter}")
-
-                # Submit merge job to CPU thread (async)
-                audio_wav_files = sorted(
-                    glob.glob(f"{result_dir}/*.wav"),
-                    key=lambda x: int(x.split("_")[-1].split(".")[0]),
-                )
-                futures.append(
-                    executor.submit(self._merge_wav_in_chapter, audio_wav_files, chapter_id)
-                )
+        # clear unused memory
+        torch.cuda.empty_cache()
+        gc.collect()
+        self.tts_engine.reset_seed()
 
-                # ✅ While CPU merges chapter N, GPU moves to chapter N+1
+        mergers = {}
+        workers = self.stage_workers
+        pipeline = Pipeline(
+            [
+                Stage("prepare", lambda chapter: self._prepare_stage(chapter, progress), workers["prepare"], queue_size=2),
+                Stage("acoustic", self._acoustic_stage, workers["acoustic"], queue_size=4),
+                Stage("vocoder", lambda task: self._vocoder_stage(task, progress), workers["vocoder"], queue_size=2),
+                Stage("merge", lambda task: self._merge_stage(task, mergers), workers["merge"], queue_size=8),
+                Stage("encode", encode_and_count, workers["encode"], queue_size=4),
+            ],
+            metrics_callback=(lambda metrics: status_dict.update(stages=metrics)) if status_dict is not None else None,
+        )
+        try:
+            for chapter_id, json_file, merge_audio_file in pipeline.run(tqdm(chapters, desc="Processing chapters ...")):
+                results[chapter_id] = (json_file, merge_audio_file)
+        finally:
+            for merger in mergers.values():
+                merger.abort()
+        if self.audio_cache is not None:
+            logger.info(f"Audio cache: {self.audio_cache.stats()}")
 
-                if status_dict:
-                    status_dict["progress"] = i + 1
-                    logger.info(f"Updated progress to {status_dict['progress']}/{status_dict['total']}")
+        # Collect results (merge outputs) in chapter order
+        sync_json_lst, merge_audio_lst = [], []
+        for tts_dir in tsv_chapter_list:
+            json_file, merge_audio_file = results[int(os.path.basename(os.path.normpath(tts_dir)).split("_")[-1])]
+            sync_json_lst.append(json_file)
+            merge_audio_lst.append(merge_audio_file)
+        return sync_json_lst, merge_audio_lst
 
-            # Collect results (merge outputs)
-            for future in as_completed(futures):
-                json_file, merge_audio_file = future.result()
-                sync_json_lst.append(json_file)
-                merge_audio_lst.append(merge_audio_file)
 
-        return sync_json_lst, merge_audio_lst
+def _to_pcm16(wav):
+    """Convert a float waveform tensor of shape (1, num_samples) to 16-bit PCM bytes."""
+    return (wav.clamp(-1, 1) * 32767).round().to(torch.int16).numpy().tobytes()
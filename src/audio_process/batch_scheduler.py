@@ -0,0 +1,49 @@
+import math
+
+
+def predict_num_frames(tokens_lens, prompt_tokens_len, prompt_features_len, speed=1.0):
+    """
+    Description: Predict the number of feature frames of each item, the same way as
+        ZipVoice.forward_text_inference_ratio_duration (prompt frames included).
+    Input:
+        tokens_lens: list[int], the number of tokens of each text.
+        prompt_tokens_len: int, the number of tokens of the prompt transcription.
+        prompt_features_len: int, the number of feature frames of the prompt wav.
+        speed: float, the speech speed.
+    Return:
+        num_frames: list[int], the predicted number of frames of each item.
+    """
+    return [
+        prompt_features_len + math.ceil(prompt_features_len / prompt_tokens_len * tokens_len / speed)
+        for tokens_len in tokens_lens
+    ]
+
+
+def make_batches(num_frames, max_frames, max_batch_size=None):
+    """
+    Description: Group items of similar length into batches whose padded size stays under a frame budget.
+        Items are sorted by length, so each batch is a bucket of neighbouring lengths and little of it is padding.
+        An item longer than max_frames gets a batch of its own.
+    Input:
+        num_frames: list[int], the predicted number of frames of each item.
+        max_frames: int, the maximum of batch size * longest item in the batch.
+        max_batch_size: int, the maximum number of items in a batch (no limit if None).
+    Return:
+        batches: list[list[int]], the indices of the items of each batch.
+            Concatenated, they are a permutation of range(len(num_frames)).
+    """
+    order = sorted(range(len(num_frames)), key=lambda i: num_frames[i])
+
+    batches, current = [], []
+    for i in order:
+        # Items come in ascending order, so the new one is the longest of the batch
+        padded_frames = (len(current) + 1) * num_frames[i]
+        full = max_batch_size is not None and len(current) >= max_batch_size
+        if current and (padded_frames > max_frames or full):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
@@ -0,0 +1,267 @@
+import inspect
+import math
+import os
+import sys
+import torch
+# Add ZipVoice repo to path
+sys.path.append("src/ZipVoice")  # change if cloned elsewhere
+
+from lhotse.utils import fix_random_seed
+from zipvoice.bin.infer_zipvoice import get_parser, load_model, load_prompt, sample_batch, decode_batch
+from zipvoice.utils.common import AttributeDict
+from src.audio_process.batch_scheduler import predict_num_frames, make_batches
+from src.utils import file_sha256
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# One engine per (model, checkpoint, ...) in each process
+_ENGINES = {}
+# Shortest audio a frame-packed chunk may be given, a smaller budget would cut the text into slivers
+MIN_CHUNK_SECONDS = 5
+
+
+class TtsEngine:
+    def __init__(self, model_dir="src/model", checkpoint_name="iter-525000-avg-2.pt",
+                 model_name="zipvoice", tokenizer="espeak", lang="vi", seed=240899, batch_size=8,
+                 max_frames=16000, sort_window=64):
+        """
+        Description: Load the tokenizer, the ZipVoice model and the vocoder once and keep them on the device.
+        Input:
+            model_dir: str, the directory that contains the checkpoint, model.json and tokens.txt.
+            checkpoint_name: str, the name of the model checkpoint in model_dir.
+            model_name: str, "zipvoice" or "zipvoice_distill".
+            tokenizer: str, the tokenizer type.
+            lang: str, the language used by the espeak tokenizer.
+            seed: int, the random seed, reset by reset_seed and at the start of every synthesize call.
+            batch_size: int, the maximum number of texts generated together in one model.sample call.
+            max_frames: int, the frame budget of a batch (batch size * longest predicted frames, prompt included).
+            sort_window: int, the number of consecutive texts bucketed by length together in plan.
+        """
+        # Start from the defaults of the infer_zipvoice command line
+        self.params = AttributeDict(vars(get_parser().parse_args([])))
+        self.params.update(
+            model_name=model_name,
+            model_dir=model_dir,
+            checkpoint_name=checkpoint_name,
+            tokenizer=tokenizer,
+            lang=lang,
+            seed=seed,
+        )
+        logger.info(f"Loading TTS engine from {model_dir}/{checkpoint_name}")
+        self.model, self.vocoder, self.tokenizer, self.feature_extractor = load_model(self.params)
+        self.device = self.params.device
+        self.sampling_rate = self.params.sampling_rate
+        self.batch_size = batch_size
+        self.max_frames = max_frames
+        self.sort_window = sort_window
+        self.checkpoint_hash = None
+        self.prompt_hashes = {}
+
+    def cache_settings(self, prompt):
+        """
+        Description: Get everything besides the text that the synthesized audio depends on, to build AudioCache keys.
+        Input:
+            prompt: tuple, (prompt_wav, prompt_text), the path to the prompt wav and its transcription.
+        Return:
+            settings: dict, the prompt id, the checkpoint hash and the sampling settings.
+        """
+        prompt_wav, prompt_text = prompt
+        if self.checkpoint_hash is None:
+            self.checkpoint_hash = file_sha256(os.path.join(self.params.model_dir, self.params.checkpoint_name))
+        prompt_file = (os.path.abspath(prompt_wav), os.path.getmtime(prompt_wav))
+        if prompt_file not in self.prompt_hashes:
+            self.prompt_hashes[prompt_file] = file_sha256(prompt_wav)
+        return {
+            "prompt": [self.prompt_hashes[prompt_file], prompt_text],
+            "checkpoint": self.checkpoint_hash,
+            "num_step": self.params.num_step,
+            "guidance_scale": self.params.guidance_scale,
+            "speed": self.params.speed,
+            "t_shift": self.params.t_shift,
+            "seed": self.params.seed,
+        }
+
+    def prompt_lens(self, prompt):
+        """
+        Description: Get the lengths of a prompt that the predicted durations are derived from.
+        Input:
+            prompt: tuple, (prompt_wav, prompt_text), the path to the prompt wav and its transcription.
+        Return:
+            prompt_tokens_len: int, the number of tokens of the transcription.
+            prompt_features_len: int, the number of feature frames of the wav.
+        """
+        prompt_wav, prompt_text = prompt
+        prompt_tokens, _, prompt_features_lens, _ = load_prompt(
+            prompt_text=prompt_text,
+            prompt_wav=prompt_wav,
+            tokenizer=self.tokenizer,
+            feature_extractor=self.feature_extractor,
+            device=self.device,
+            target_rms=self.params.target_rms,
+            feat_scale=self.params.feat_scale,
+            sampling_rate=self.sampling_rate,
+        )
+        return len(prompt_tokens[0]), int(prompt_features_lens[0])
+
+    def plan(self, texts, prompt):
+        """
+        Description: Tokenize texts (G2P, on the CPU) and bucket them into batches under the frame budget.
+            Texts are bucketed by predicted length within windows of sort_window consecutive texts,
+            so a consumer putting the waveforms back in order never holds more than about one window of them.
+        Input:
+            texts: list[str], the texts to synthesize.
+            prompt: tuple, (prompt_wav, prompt_text), the path to the prompt wav and its transcription.
+        Return:
+            tokens: list[list[int]], the tokens of each text.
+            batches: list[list[int]], the indices of the texts of each batch, in synthesis order.
+        """
+        tokens = self.tokenizer.texts_to_token_ids(texts)
+        prompt_tokens_len, prompt_features_len = self.prompt_lens(prompt)
+        num_frames = predict_num_frames([len(t) for t in tokens], prompt_tokens_len,
+                                        prompt_features_len, speed=self.params.speed)
+
+        batches = []
+        for start in range(0, len(texts), self.sort_window):
+            window = num_frames[start:start + self.sort_window]
+            for batch in make_batches(window, self.max_frames, max_batch_size=self.batch_size):
+                batches.append([start + j for j in batch])
+        return tokens, batches
+
+    @torch.inference_mode()
+    def sample(self, texts, tokens, prompt):
+        """
+        Description: Run the acoustic model on one batch.
+        Input:
+            texts: list[str], the texts of the batch.
+            tokens: list[list[int]], their tokens.
+            prompt: tuple, (prompt_wav, prompt_text), the path to the prompt wav and its transcription.
+        Return:
+            features: tuple, the outputs of sample_batch, to give to decode.
+        """
+        prompt_wav, prompt_text = prompt
+        return sample_batch(
+            prompt_text=prompt_text,
+            prompt_wav=prompt_wav,
+            texts=texts,
+            tokens=tokens,
+            model=self.model,
+            tokenizer=self.tokenizer,
+            feature_extractor=self.feature_extractor,
+            device=self.device,
+            num_step=self.params.num_step,
+            guidance_scale=self.params.guidance_scale,
+            speed=self.params.speed,
+            t_shift=self.params.t_shift,
+            target_rms=self.params.target_rms,
+            feat_scale=self.params.feat_scale,
+            sampling_rate=self.sampling_rate,
+        )
+
+    @torch.inference_mode()
+    def decode(self, features):
+        """
+        Description: Run the vocoder on the features of one batch.
+        Input:
+            features: tuple, the value returned by sample.
+        Return:
+            wavs: list[torch.Tensor], one waveform of shape (1, num_samples) on the CPU per text of the batch.
+            metrics: dict, the time and real-time factor of the batch.
+        """
+        pred_features, pred_features_lens, prompt_rms, t_no_vocoder = features
+        wavs, metrics = decode_batch(
+            pred_features=pred_features,
+            pred_features_lens=pred_features_lens,
+            prompt_rms=prompt_rms,
+            t_no_vocoder=t_no_vocoder,
+            vocoder=self.vocoder,
+            target_rms=self.params.target_rms,
+            sampling_rate=self.sampling_rate,
+        )
+        return [wav.cpu() for wav in wavs], metrics
+
+    def reset_seed(self):
+        """
+        Description: Reset the random seed, so that the same texts give the same audio.
+        """
+        fix_random_seed(self.params.seed)
+
+    def synthesize(self, texts, prompt):
+        """
+        Description: Synthesize a list of texts with the voice of the prompt, from the random seed.
+            AudioProcessor runs plan, sample and decode as separate pipeline stages instead,
+            this is the same work in one call for other callers.
+        Input:
+            texts: list[str], the texts to synthesize.
+            prompt: tuple, (prompt_wav, prompt_text), the path to the prompt wav and its transcription.
+        Return:
+            wavs: list[torch.Tensor], one waveform of shape (1, num_samples) on the CPU per text, in order.
+        """
+        self.reset_seed()
+        tokens, batches = self.plan(texts, prompt)
+        wavs = [None] * len(texts)
+        for batch in batches:
+            features = self.sample([texts[i] for i in batch], [tokens[i] for i in batch], prompt)
+            for i, wav in zip(batch, self.decode(features)[0]):
+                wavs[i] = wav
+        return wavs
+
+
+class FrameEstimator:
+    def __init__(self, engine, prompt, max_frames=None):
+        """
+        Description: Predict the number of frames ZipVoice generates for texts, from their tokens
+            and the frames per token of the prompt, to pack chunks by compute instead of characters.
+            Raises ValueError if the chunk frame budget is under MIN_CHUNK_SECONDS of audio.
+        Input:
+            engine: TtsEngine, the engine whose tokenizer and speed are used.
+            prompt: tuple, (prompt_wav, prompt_text), the path to the prompt wav and its transcription.
+            max_frames: int, the frame budget of a chunk, prompt excluded. By default, a full batch
+                of chunks of this size (prompt included) fills the frame budget of the engine:
+                engine.max_frames // engine.batch_size minus the prompt frames, i.e. 2000 frames
+                (21 s at 24 kHz) minus the prompt with the default engine.
+        """
+        self.engine = engine
+        prompt_tokens_len, prompt_features_len = engine.prompt_lens(prompt)
+        self.frames_per_token = prompt_features_len / prompt_tokens_len / engine.params.speed
+        if max_frames is None:
+            max_frames = engine.max_frames // engine.batch_size - prompt_features_len
+        min_frames = math.ceil(MIN_CHUNK_SECONDS / engine.feature_extractor.frame_shift)
+        if max_frames < min_frames:
+            raise ValueError(
+                f"Chunk frame budget of {max_frames} frames is under {min_frames} frames ({MIN_CHUNK_SECONDS} s), "
+                f"the prompt takes {prompt_features_len} frames: use a shorter prompt, a smaller batch_size "
+                f"or a larger max_frames for the engine"
+            )
+        self.max_frames = max_frames
+        # Everything the chunks depend on, for the extraction cache key
+        prompt_hash = engine.cache_settings(prompt)["prompt"][0]
+        self.cache_id = f"{prompt_hash[:16]}_{engine.params.lang}_{engine.params.speed}_{max_frames}"
+
+    def __call__(self, texts):
+        """
+        Description: Predict the number of generated frames of each text, prompt excluded.
+        Input:
+            texts: list[str], the texts.
+        Return:
+            num_frames: list[int], the predicted number of frames of each text.
+        """
+        tokens = self.engine.tokenizer.texts_to_token_ids(texts)
+        return [math.ceil(len(t) * self.frames_per_token) for t in tokens]
+
+
+def get_tts_engine(**kwargs):
+    """
+    Description: Return the TtsEngine of the current process, building it on first use.
+    Input:
+        kwargs: the arguments of TtsEngine.
+    Return:
+        engine: TtsEngine, the shared engine.
+    """
+    # Key on the full argument list so that explicit defaults and omitted ones share an engine
+    arguments = inspect.signature(TtsEngine).bind(**kwargs)
+    arguments.apply_defaults()
+    key = tuple(sorted(arguments.arguments.items()))
+    if key not in _ENGINES:
+        _ENGINES[key] = TtsEngine(**kwargs)
+    return _ENGINES[key]
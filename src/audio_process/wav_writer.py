@@ -0,0 +1,120 @@
+import os
+import wave
+import soundfile as sf
+
+
+class WavWriter:
+    def __init__(self, output_path, sample_rate, channels=1, sample_width=2, block_frames=1 << 16):
+        """
+        Description: Write a 16-bit PCM wav file by appending audio to it, without keeping the audio in memory.
+            The file is written to output_path.part and renamed on close, so output_path is always complete.
+        Input:
+            output_path: str, the path to the wav file.
+            sample_rate: int, the sample rate of the wav file.
+            channels: int, the number of channels.
+            sample_width: int, the number of bytes per sample, only 2 (16-bit) is supported.
+            block_frames: int, the number of frames copied at a time from an input file.
+        """
+        if sample_width != 2:
+            raise ValueError(f"Only 16-bit PCM is supported, got sample_width={sample_width}")
+        self.output_path = output_path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.block_frames = block_frames
+        self.num_frames = 0
+        self.wav = wave.open(f"{output_path}.part", "wb")
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(sample_width)
+        self.wav.setframerate(sample_rate)
+
+    @property
+    def position_ms(self):
+        """The duration written so far, in milliseconds."""
+        return self.num_frames * 1000 / self.sample_rate
+
+    def write_frames(self, frames):
+        """
+        Description: Append raw PCM frames.
+        Input:
+            frames: bytes, 16-bit little-endian PCM frames with the writer's number of channels.
+        """
+        self.wav.writeframesraw(frames)
+        self.num_frames += len(frames) // (self.channels * self.sample_width)
+
+    def write_silence(self, duration_ms):
+        """
+        Description: Append silence.
+        Input:
+            duration_ms: int, the duration of the silence in milliseconds.
+        """
+        num_frames = round(self.sample_rate * duration_ms / 1000)
+        self.write_frames(bytes(num_frames * self.channels * self.sample_width))
+
+    def write_file(self, wav_path):
+        """
+        Description: Append the audio of a wav file, one block at a time.
+            16-bit PCM files are copied as is, other sample formats are converted.
+        Input:
+            wav_path: str, the path to the wav file, with the writer's sample rate and number of channels.
+        """
+        try:
+            with wave.open(wav_path, "rb") as wav:
+                if wav.getsampwidth() == self.sample_width:
+                    self._check_format(wav_path, wav.getframerate(), wav.getnchannels())
+                    while frames := wav.readframes(self.block_frames):
+                        self.write_frames(frames)
+                    return
+        except wave.Error:
+            pass  # not PCM, e.g. 32-bit float
+
+        info = sf.info(wav_path)
+        self._check_format(wav_path, info.samplerate, info.channels)
+        for block in sf.blocks(wav_path, blocksize=self.block_frames, dtype="int16", always_2d=True):
+            self.write_frames(block.tobytes())
+
+    def _check_format(self, wav_path, sample_rate, channels):
+        if sample_rate != self.sample_rate or channels != self.channels:
+            raise ValueError(
+                f"{wav_path} is {sample_rate} Hz, {channels} channels, "
+                f"expected {self.sample_rate} Hz, {self.channels} channels"
+            )
+
+    def close(self):
+        """
+        Description: Finish the header and move the file to output_path.
+        """
+        self.wav.close()
+        os.replace(f"{self.output_path}.part", self.output_path)
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """
+        Description: Close and delete the partial file, leaving output_path untouched.
+        """
+        self.wav.close()
+        os.remove(f"{self.output_path}.part")
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_wav(output_path, frames, sample_rate, channels=1):
+    """
+    Description: Write 16-bit PCM frames to a wav file in one go.
+    Input:
+        output_path: str, the path to the wav file.
+        frames: bytes, 16-bit little-endian PCM frames.
+        sample_rate: int, the sample rate of the frames.
+        channels: int, the number of channels.
+    """
+    with wave.open(output_path, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(frames)
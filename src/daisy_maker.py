@@ -1,16 +1,20 @@
 from src.audio_process.audio_processor import AudioProcessor
+from src.audio_process.tts_engine import FrameEstimator
 from src.doc_process.text_processor import TextProcessor
 from src.logging_config import setup_logger
 from src.utils import read_txt_file
+from src.stage_manifest import StageManifest
+from src.daisy_packager import get_packager
 import os 
 import glob
-import sys
+import json
 from datetime import datetime
 import shutil
-from anemone import anemone as anemone_main
 
 logger = setup_logger(__name__)
 
+# Audio formats accepted by Anemone
+ANEMONE_AUDIO_FORMATS = ("mp3", "wav")
 
 
 class DaisyMaker:
@@ -23,14 +27,23 @@ class DaisyMaker:
                 tts_model_dir="src/model",
                 tts_checkpoint_dir="iter-525000-avg-2.pt",
                 is_split_by_sentence=False,
-                chunk_size=400):
+                chunk_size=400,
+                audio_format="mp3",
+                audio_bitrate="64k",
+                chunk_by_frames=False):
         """
         Description: Initialize the DaisyMaker class.
         Input:
             daisy_output_dir: str, the directory to save the daisy book.
             audio_output_dir: str, the directory to save the audio files.
             tts_checkpoint_dir: str, the path to the TTS model checkpoint.
+            audio_format: str, the format of the audio files in the book, "mp3" or "wav".
+            audio_bitrate: str, the bitrate of the mp3 files, e.g. "64k".
+            chunk_by_frames: bool, pack chunks by the acoustic frames the TTS model predicts for them
+                instead of by chunk_size characters.
         """
+        if audio_format not in ANEMONE_AUDIO_FORMATS:
+            raise ValueError(f"Anemone only packages {ANEMONE_AUDIO_FORMATS} audio, got {audio_format}")
         self.daisy_output_dir = daisy_output_dir
         self.audio_output_dir = audio_output_dir
         self.xml_output_dir = xml_output_dir
@@ -38,8 +51,14 @@ class DaisyMaker:
         self.tts_model_dir = tts_model_dir
         self.is_split_by_sentence = is_split_by_sentence
         self.chunk_size = chunk_size
-        self.audio_processor = AudioProcessor(self.audio_output_dir, wav_file_path=wav_file_path, wav_text_path=wav_text_path, model_dir=self.tts_model_dir, checkpoint_dir=self.tts_checkpoint_dir)
-        self.text_processor = TextProcessor(None, self.xml_output_dir, split_by_sentence=self.is_split_by_sentence, chunk_size=self.chunk_size)
+        self.audio_processor = AudioProcessor(self.audio_output_dir, wav_file_path=wav_file_path, wav_text_path=wav_text_path, model_dir=self.tts_model_dir, checkpoint_dir=self.tts_checkpoint_dir,
+                                              audio_format=audio_format, audio_bitrate=audio_bitrate)
+        self.frame_estimator = None
+        if chunk_by_frames:
+            self.frame_estimator = FrameEstimator(self.audio_processor.tts_engine,
+                                                  (self.audio_processor.wav_file, self.audio_processor.wav_text))
+        self.text_processor = TextProcessor(None, self.xml_output_dir, split_by_sentence=self.is_split_by_sentence, chunk_size=self.chunk_size,
+                                            frame_estimator=self.frame_estimator)
         
         os.makedirs(self.daisy_output_dir, exist_ok=True)
         os.makedirs(self.audio_output_dir, exist_ok=True)
@@ -62,73 +81,101 @@ class DaisyMaker:
             book_date: str, the date of the book.
             book_publisher: str, the publisher of the book.
             book_uid: str, the uid of the book.
+        Each stage records its completion in a manifest in daisy_output_dir, so re-running
+        the same job_id after a failure skips the stages that already completed.
         """
         try:
-            self.text_processor = TextProcessor(input_file, self.xml_output_dir)
+            self.text_processor = TextProcessor(input_file, self.xml_output_dir, frame_estimator=self.frame_estimator)
             book_date = datetime.strptime(book_date, "%m/%d/%Y").strftime("%Y-%m-%d")
+            manifest = StageManifest(os.path.join(self.daisy_output_dir, f"stages_{job_id}.json"))
+            final_zip_path = os.path.join(self.daisy_output_dir, f"{book_title}_daisy.zip")
+            if manifest.is_done("package") and os.path.exists(final_zip_path):
+                logger.info(f"DAISY book already created at {final_zip_path}")
+                status_dict["progress"] = 100
+                status_dict["status"] = "finished"
+                return
 
             # Step 1: Read pdf and convert to XML format for each chapter
-            status_dict["status"] = "Creating XML from PDF..."
-            xml_chapters_lst = self.text_processor.make_xml_lst(title=book_title,
-                                                           author=book_author,
-                                                           date=book_date,
-                                                           publisher=book_publisher,
-                                                           uid=book_uid)
+            xml_chapter_futures = None
+            if manifest.is_done("xml"):
+                logger.info("XML already created, skipping")
+                xml_stage = manifest.get("xml")
+                xml_chapters_lst = xml_stage["chapters"]
+                with open(xml_stage["sections"], "r", encoding="utf-8") as f:
+                    self.text_processor.processed_lst = json.load(f)
+            else:
+                status_dict.update(stage="xml", status="Creating XML from PDF...")
+                # The chapter files are saved in a process pool while the audio is synthesized
+                xml_chapter_futures = self.text_processor.make_xml_lst(title=book_title,
+                                                               author=book_author,
+                                                               date=book_date,
+                                                               publisher=book_publisher,
+                                                               uid=book_uid,
+                                                               concurrent=True)
+                # Keep the extracted sections, the TSV step needs them on a re-run
+                sections_path = os.path.join(self.xml_output_dir, "sections.json")
+                with open(sections_path, "w", encoding="utf-8") as f:
+                    json.dump(self.text_processor.processed_lst, f, ensure_ascii=False)
             status_dict["progress"] = 10 # Arbitrary progress update
 
             # Step 2: Create tsv files for TTS
-            status_dict["status"] = "Creating TSV files for TTS..."
-            prompt_text = read_txt_file("src/model/prompt.txt")[0]
             tsv_path = os.path.join("data", f"tsv_dir_{job_id}")
-            
-            # Clean up old tsv_dir if it exists to ensure a fresh start
-            if os.path.exists(tsv_path):
-                shutil.rmtree(tsv_path)
-
-            self.text_processor.create_tts_for_tts_with_chunks(
-                                                promt_wav_file="src/model/prompt.wav",
-                                                prompt_text=prompt_text,
-                                                output_dir=tsv_path,
-                                                )
+            if manifest.is_done("tsv"):
+                logger.info("TSV files already created, skipping")
+            else:
+                status_dict.update(stage="tsv", status="Creating TSV files for TTS...")
+                prompt_text = read_txt_file("src/model/prompt.txt")[0]
+
+                # Clean up a partial tsv_dir, the tsv files are written in append mode
+                if os.path.exists(tsv_path):
+                    shutil.rmtree(tsv_path)
+
+                self.text_processor.create_tts_for_tts_with_chunks(
+                                                    promt_wav_file="src/model/prompt.wav",
+                                                    prompt_text=prompt_text,
+                                                    output_dir=tsv_path,
+                                                    )
+                manifest.mark_done("tsv", tsv_path)
             status_dict["progress"] = 20
 
             # Step 3: Create audio from TSV files
-            status_dict["status"] = "Starting Text-to-Speech synthesis..."
+            status_dict.update(stage="tts", status="Starting Text-to-Speech synthesis...")
             tsv_lst = sorted(glob.glob(f"{tsv_path}/chapter_*/"), key=lambda x: int(os.path.basename(os.path.normpath(x)).split("_")[-1]))
             
             # This is the longest step, so we pass the status dict to it
             sync_json_lst, merge_audio_lst = self.audio_processor.create_audio_for_book(
                 tsv_chapter_list=tsv_lst,
-                status_dict=status_dict
+                status_dict=status_dict,
+                manifest=manifest,
             )
 
+            if xml_chapter_futures is not None:
+                xml_chapters_lst = [future.result() for future in xml_chapter_futures]
+                manifest.mark_done("xml", {"chapters": xml_chapters_lst, "sections": sections_path})
+
             if len(sync_json_lst) != len(xml_chapters_lst) or len(merge_audio_lst) != len(xml_chapters_lst):
                 raise ValueError("The number of sync json files, audio files and xml files are not equal.")
 
             # Step 4: Create daisy book using Anemone-Daisy-Maker
-            status_dict["status"] = "Packaging DAISY book..."
+            status_dict.update(stage="package", status="Packaging DAISY book...")
             status_dict["progress"] = 95
             
-            sys.argv = [
-                "anemone",
-                "--title", book_title,
-                "--creator", book_author,
-                "--lang", "vi",
-                "--date", book_date,
-                "--publisher", book_publisher,
-                "--daisy3",
-            ]
-            sys.argv.extend(merge_audio_lst)
-            sys.argv.extend(xml_chapters_lst)
-            sys.argv.extend(sync_json_lst)
-
-            logger.info("Running Anemone: %s", " ".join(sys.argv))
-            anemone_main()
-
-            # Move output daisy book to the correct directory
-            output_zip = "output_daisy.zip"
-            final_zip_path = os.path.join(self.daisy_output_dir, f"{book_title}_daisy.zip")
-            shutil.move(output_zip, final_zip_path)
+            # Anemone runs in a separate process and writes to its own temporary directory
+            future = get_packager().submit(
+                final_zip_path,
+                merge_audio_lst,
+                xml_chapters_lst,
+                sync_json_lst,
+                title=book_title,
+                creator=book_author,
+                date=book_date,
+                publisher=book_publisher,
+                lang="vi",
+            )
+            warnings = future.result()
+            if warnings:
+                logger.warning(f"Anemone reported {len(warnings)} warnings for {final_zip_path}")
+            manifest.mark_done("package", final_zip_path)
 
             # Clean up the temporary tsv directory
             shutil.rmtree(tsv_path)
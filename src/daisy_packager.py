@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from anemone import anemone
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Shared by the jobs of a process, see get_packager
+_PACKAGER = None
+
+
+def package_daisy(output_zip, audio_files, xml_files, sync_files, title, creator, date, publisher, lang="vi"):
+    """
+    Description: Build a DAISY 3 book with Anemone, called as a library.
+        Anemone writes to a temporary directory next to output_zip, and the zip is moved into place
+        once complete, so concurrent packagings never share a file and output_zip is never partial.
+    Input:
+        output_zip: str, the path to the DAISY zip to create.
+        audio_files: list, the audio file of each chapter.
+        xml_files: list, the DTBook xml file of each chapter.
+        sync_files: list, the sync marker json file of each chapter.
+        title: str, the title of the book.
+        creator: str, the author of the book.
+        date: str, the date of the book, YYYY-MM-DD.
+        publisher: str, the publisher of the book.
+        lang: str, the language of the book.
+    Return:
+        warnings: list, the warnings reported by Anemone.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_zip))
+    tmp_dir = tempfile.mkdtemp(prefix="anemone_", dir=output_dir)
+    try:
+        # Anemone takes the output file as the input ending in .zip, and warns if its name lacks "daisy"
+        tmp_zip = os.path.join(tmp_dir, "book_daisy.zip")
+        files = [os.path.abspath(f) for f in [*audio_files, *xml_files, *sync_files]]
+        warnings = anemone(
+            *files,
+            tmp_zip,
+            title=title,
+            creator=creator,
+            lang=lang,
+            date=date,
+            publisher=publisher,
+            daisy3=True,
+            info_callback=logger.info,
+            warning_callback=logger.warning,
+        )
+        os.replace(tmp_zip, output_zip)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return warnings
+
+
+class DaisyPackager:
+    def __init__(self, max_workers=1):
+        """
+        Description: Run package_daisy in a pool of processes, so Anemone's CPU-bound work
+            does not hold the caller's interpreter and several books can be packaged at once.
+        Input:
+            max_workers: int, the number of books packaged at the same time.
+        """
+        # spawn: the pool must not fork a process holding a CUDA context
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, output_zip, audio_files, xml_files, sync_files, **metadata):
+        """
+        Description: Start packaging a book.
+        Input:
+            output_zip, audio_files, xml_files, sync_files: see package_daisy.
+            metadata: title, creator, date, publisher and lang, see package_daisy.
+        Return:
+            future: Future, resolving to the warnings of Anemone.
+        """
+        return self.executor.submit(package_daisy, output_zip, audio_files, xml_files, sync_files, **metadata)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def get_packager(max_workers=1):
+    """
+    Description: Return the DaisyPackager of the current process, starting it on first use.
+    Input:
+        max_workers: int, the number of workers of the pool, if it is created by this call.
+    Return:
+        packager: DaisyPackager, the shared packager.
+    """
+    global _PACKAGER
+    if _PACKAGER is None:
+        _PACKAGER = DaisyPackager(max_workers)
+    return _PACKAGER
@@ -0,0 +1,76 @@
+import json
+import os
+from src.utils import file_sha256
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Bump when the extraction or splitting changes, so entries made by older code are ignored
+EXTRACTION_VERSION = 4
+
+
+class ExtractionCache:
+    def __init__(self, cache_dir="data/cache/extraction"):
+        """
+        Description: An on-disk cache of the sections extracted from pdf files, with their sentence splits,
+            keyed by the content hash of the pdf and the splitting parameters.
+        Input:
+            cache_dir: str, the directory of the cache.
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(pdf_file, split_by_sentence, chunk_size, frame_estimator=None):
+        """
+        Description: Build the cache key of a pdf file.
+        Input:
+            pdf_file: str, the path to the pdf file.
+            split_by_sentence: bool, whether the sections are split by sentence.
+            chunk_size: int, the maximum length of a chunk if they are not.
+            frame_estimator: FrameEstimator, if set, chunks are packed by predicted frames instead of chunk_size.
+        Return:
+            key: str, the hex SHA-256 of the pdf followed by the splitting parameters.
+        """
+        if split_by_sentence:
+            split = "sent"
+        elif frame_estimator is not None:
+            split = f"frames{frame_estimator.cache_id}"
+        else:
+            split = f"chunk{chunk_size}"
+        return f"{file_sha256(pdf_file)}_{split}_v{EXTRACTION_VERSION}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def lookup(self, key):
+        """
+        Description: Get the cached sections of a key.
+        Input:
+            key: str, the cache key.
+        Return:
+            sections: list[dict], the cached sections, or None if the key is not cached.
+        """
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring corrupted extraction cache entry {key}")
+            return None
+
+    def store(self, key, sections):
+        """
+        Description: Add the sections of a pdf file to the cache.
+        Input:
+            key: str, the cache key.
+            sections: list[dict], the sections with their sentence splits.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several workers may share the cache, never expose a partial file
+        tmp_path = f"{path}.{os.getpid()}.part"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(sections, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
@@ -0,0 +1,159 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pymupdf
+from src.utils import file_sha256
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Tesseract language data used by the OCR, it must be installed with Tesseract
+OCR_LANGUAGE = "vie"
+OCR_DPI = 300
+# Pages given to a worker at a time, their texts are cached as soon as the batch is done
+OCR_BATCH_PAGES = 8
+
+
+def find_image_only_pages(pdf_file, page_texts):
+    """
+    Description: Find the pages that have no text layer but show images, i.e. scanned pages.
+    Input:
+        pdf_file: str, the path to the pdf file.
+        page_texts: list[str], the text layer of each page.
+    Return:
+        pages: list[int], the 0-based numbers of the image-only pages.
+    """
+    empty_pages = [i for i, text in enumerate(page_texts) if not text.strip()]
+    if not empty_pages:
+        return []
+    with pymupdf.open(pdf_file) as doc:
+        return [i for i in empty_pages if doc[i].get_images()]
+
+
+def _init_ocr_worker():
+    # One Tesseract thread per worker, the pool already uses every CPU
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def _ocr_page_batch(pdf_file, pages, language, dpi):
+    """
+    OCR some pages of a pdf, in a worker process with its own document.
+    If OCR is not available (Tesseract or its language data missing), the texts of the pages
+    not OCR'd yet are None and the error is returned.
+    """
+    texts = []
+    with pymupdf.open(pdf_file) as doc:
+        for page_number in pages:
+            page = doc[page_number]
+            try:
+                textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+            except RuntimeError as e:
+                return pages, texts + [None] * (len(pages) - len(texts)), str(e)
+            texts.append(page.get_text(textpage=textpage))
+    return pages, texts, None
+
+
+class OcrPageCache:
+    def __init__(self, cache_dir="data/cache/ocr"):
+        """
+        Description: An on-disk cache of the OCR text of single pages, so an interrupted book
+            does not OCR its pages again.
+        Input:
+            cache_dir: str, the directory of the cache.
+        """
+        self.cache_dir = cache_dir
+
+    def _path(self, key, page):
+        return os.path.join(self.cache_dir, key, f"{page}.txt")
+
+    def lookup(self, key, page):
+        """
+        Description: Get the cached OCR text of a page.
+        Input:
+            key: str, the key of the pdf and OCR settings.
+            page: int, the 0-based page number.
+        Return:
+            text: str, the text of the page, or None if it is not cached.
+        """
+        try:
+            with open(self._path(key, page), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, page, text):
+        """
+        Description: Add the OCR text of a page to the cache.
+        Input:
+            key: str, the key of the pdf and OCR settings.
+            page: int, the 0-based page number.
+            text: str, the text of the page.
+        """
+        path = self._path(key, page)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several workers may share the cache, never expose a partial file
+        tmp_path = f"{path}.{os.getpid()}.part"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def ocr_pages(pdf_file, pages, cache_dir="data/cache/ocr", num_workers=None,
+              language=OCR_LANGUAGE, dpi=OCR_DPI):
+    """
+    Description: OCR pages of a pdf with Tesseract through PyMuPDF, in a process pool.
+        Pages found in the page cache are not OCR'd again.
+    Input:
+        pdf_file: str, the path to the pdf file.
+        pages: list[int], the 0-based numbers of the pages to OCR.
+        cache_dir: str, the directory of the page cache, None to disable it.
+        num_workers: int, the number of worker processes, defaults to the number of CPUs.
+        language: str, the Tesseract language.
+        dpi: int, the resolution the pages are rendered at.
+    Return:
+        page_texts: dict[int, str], the text of each page, pages whose OCR failed are left out.
+    """
+    cache = OcrPageCache(cache_dir) if cache_dir else None
+    key = f"{file_sha256(pdf_file)}_{language}_{dpi}"
+    page_texts = {}
+    missing = []
+    for page in pages:
+        text = cache.lookup(key, page) if cache is not None else None
+        if text is None:
+            missing.append(page)
+        else:
+            page_texts[page] = text
+    if not missing:
+        return page_texts
+    logger.info(f"OCR of {len(missing)} pages of {pdf_file}, {len(page_texts)} pages cached")
+
+    batches = [missing[i:i + OCR_BATCH_PAGES] for i in range(0, len(missing), OCR_BATCH_PAGES)]
+    num_workers = min(num_workers or os.cpu_count() or 1, len(batches))
+
+    errors = []
+
+    def collect(batch_pages, texts, error):
+        if error is not None:
+            errors.append(error)
+        for page, text in zip(batch_pages, texts):
+            if text is None:
+                continue
+            page_texts[page] = text
+            if cache is not None:
+                cache.store(key, page, text)
+
+    if num_workers <= 1:
+        for batch in batches:
+            collect(*_ocr_page_batch(pdf_file, batch, language, dpi))
+    else:
+        # spawn: do not fork a process that may hold a CUDA context
+        with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_ocr_worker) as executor:
+            futures = [executor.submit(_ocr_page_batch, pdf_file, batch, language, dpi) for batch in batches]
+            for future in as_completed(futures):
+                collect(*future.result())
+    if errors:
+        logger.warning(f"OCR failed on {len(pages) - len(page_texts)} pages of {pdf_file}, "
+                       f"they are left empty. Is Tesseract installed with the '{language}' language data? {errors[0]}")
+    return page_texts
+
@@ -1,37 +1,107 @@
 
 import re
+import os
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import pymupdf
+from src.doc_process.ocr import find_image_only_pages, ocr_pages
+from src.doc_process.sentence_segmenter import VI_SEGMENTER
+from src.logging_config import setup_logger
 
+logger = setup_logger(__name__)
 
-def split_sentences_with_newline(text: str) -> str:
+# Below this number of pages per worker, starting processes costs more than it saves
+PARALLEL_MIN_PAGES = 100
+# Page texts of the last pdf files read by the process
+PAGE_TEXT_CACHE_SIZE = 4
+_page_text_cache = OrderedDict()
+# Where split_long_sentence breaks a sentence, in order: after clause punctuation or before a dash, then at whitespace
+SPLIT_LEVELS = [re.compile(r"(?<=[,;:])\s+|\s+(?=[—–-]\s)"), re.compile(r"\s+")]
+# Lines starting a chapter, used to build a TOC when the pdf has no outline
+HEADING_PATTERN = re.compile(r"^(?:chương|phần|chapter|part)\s+(?:\d+|[ivxlcdm]+)\b", re.IGNORECASE)
+HEADING_MAX_LEN = 80
+# Number of lines at the top of a page where a heading is looked for
+HEADING_TOP_LINES = 5
+
+
+def _char_lengths(texts):
+    return [len(text) for text in texts]
+
+
+def split_long_sentence(sentence: str, max_cost: int, cost=_char_lengths) -> list[str]:
     """
-    Description: Insert a newline after each sentence-ending punctuation, but ignore numerical lists like '1.', '2.', or 'Chương 1.'.
+    Description: Split a sentence into pieces of at most max_cost, breaking at clause punctuation first,
+        then at whitespace, and cutting words only as a last resort, so that no chunk can exceed the limit.
+        The cost of every piece is checked as a whole, so this holds when characters cost differently too;
+        only a single character costing more than max_cost is kept above it.
     Input:
-        text: str, The input text.
+        sentence: str, the sentence.
+        max_cost: int, the maximum cost of a piece.
+        cost: callable, list[str] -> list[int], the cost of each text, characters by default,
+            or e.g. a FrameEstimator for predicted frames.
     Return:
-        str: Text with '\n' at the end of each sentence.
+        pieces: list[str], the pieces of the sentence, in order.
     """
-    # First, protect list markers by replacing "N." with a placeholder
-    protected = re.sub(
-        r"(?i)\b(chương\s+\d+|\d+)\.",  # match "1." or "Chương 1."
-        lambda m: m.group(0).replace(".", "<DOT>"),
-        text,
-    )
+    pieces = _split_to_limit(sentence, max_cost, cost, cost([" "])[0], SPLIT_LEVELS)
+    # Pieces were packed by adding the costs of their parts, check the cost of each piece as a whole
+    checked = []
+    for piece, piece_cost in zip(pieces, cost(pieces)):
+        checked.extend(_cut_to_limit(piece, max_cost, cost) if piece_cost > max_cost else [piece])
+    return checked
 
-    # Add newline after sentence-ending punctuation (., ?, !, ...)
-    protected = re.sub(r"(\.\.\.|[.!?])", r"\1\n", protected)
 
-    # Restore protected list markers
-    normalized = protected.replace("<DOT>", ".")
-    normalized = normalized.replace("“", '"').replace("”", '"')
-    normalized = normalized.replace("...", ".\n")  # Ensure ellipses also get a newline
+def _cut_to_limit(text, max_cost, cost):
+    """
+    Cut a text with no break left into pieces of at most max_cost, each the longest prefix of the rest
+    that fits, found by bisection. Only a single character above max_cost is kept over the limit.
+    """
+    pieces = []
+    while text:
+        if cost([text])[0] <= max_cost:
+            pieces.append(text)
+            break
+        fits, too_long = 1, len(text)
+        while too_long - fits > 1:
+            middle = (fits + too_long) // 2
+            if cost([text[:middle]])[0] <= max_cost:
+                fits = middle
+            else:
+                too_long = middle
+        pieces.append(text[:fits])
+        text = text[fits:]
+    return pieces
+
+
+def _split_to_limit(text, max_cost, cost, sep_cost, levels):
+    if not levels:
+        # A single word above the limit
+        return _cut_to_limit(text, max_cost, cost)
+
+    parts = [part for part in levels[0].split(text) if part.strip()]
+    pieces, current, current_cost = [], "", 0
+    for part, part_cost in zip(parts, cost(parts)):
+        if part_cost > max_cost:
+            if current:
+                pieces.append(current)
+                current, current_cost = "", 0
+            pieces.extend(_split_to_limit(part, max_cost, cost, sep_cost, levels[1:]))
+        elif current and current_cost + sep_cost + part_cost <= max_cost:
+            current += " " + part
+            current_cost += sep_cost + part_cost
+        else:
+            if current:
+                pieces.append(current)
+            current, current_cost = part, part_cost
+    if current:
+        pieces.append(current)
+    return pieces
 
-    # Clean up extra newlines
-    return re.sub(r"\n+", "\n", normalized).strip()
 
 def chunk_sentences(texts: list[str], max_len: int = 200) -> list[str]:
     """
     Description: Spilt the full chapter text into chunks with max length of max_len.
+        A sentence longer than max_len is split with split_long_sentence, so no chunk exceeds max_len.
     Input:
         texts: str, The input text.
     Return:
@@ -39,70 +109,241 @@ def chunk_sentences(texts: list[str], max_len: int = 200) -> list[str]:
     """
     chunks, current = [], ""
 
-    for sentence in texts.split("\n"):
-        if len(current) + len(sentence) + 1 <= max_len:
-            current += (" " if current else "") + sentence
+    for line in texts.split("\n"):
+        for sentence in (split_long_sentence(line, max_len) if len(line) > max_len else [line]):
+            if len(current) + len(sentence) + 1 <= max_len:
+                current += (" " if current else "") + sentence
+            else:
+                if current:
+                    chunks.append(current.strip())
+                current = sentence
+    if current:
+        chunks.append(current.strip())
+    return chunks
+
+def chunk_sentences_by_frames(texts: str, predict_frames, max_frames: int) -> list[str]:
+    """
+    Description: Spilt the full chapter text into chunks of at most max_frames predicted acoustic frames,
+        so that chunks cost about the same to synthesize whatever their number of characters.
+        A sentence above the budget is split with split_long_sentence, so no chunk exceeds max_frames.
+    Input:
+        texts: str, The input text, one sentence per line.
+        predict_frames: callable, list[str] -> list[int], the predicted frames of each sentence, e.g. a FrameEstimator.
+        max_frames: int, the frame budget of a chunk.
+    Return:
+        chunks: list[str], the chunks.
+    """
+    lines = texts.split("\n")
+    sep_frames = predict_frames([" "])[0]
+    chunks, current, current_frames = [], "", 0
+
+    for line, line_frames in zip(lines, predict_frames(lines)):
+        if line_frames > max_frames:
+            pieces = split_long_sentence(line, max_frames, predict_frames)
+            sentences = zip(pieces, predict_frames(pieces))
         else:
-            if current:
-                chunks.append(current.strip())
-            current = sentence
+            sentences = [(line, line_frames)]
+        for sentence, frames in sentences:
+            if current_frames + sep_frames + frames <= max_frames:
+                current += (" " if current else "") + sentence
+                current_frames += (sep_frames if current_frames else 0) + frames
+            else:
+                if current:
+                    chunks.append(current.strip())
+                current, current_frames = sentence, frames
     if current:
         chunks.append(current.strip())
     return chunks
 
-def process_pdf(pdf_file):
+def _extract_page_range(pdf_file, start, end):
+    """Extract the text of pages [start, end) of a pdf, in a worker process with its own document."""
+    with pymupdf.open(pdf_file) as doc:
+        return [doc[i].get_text() for i in range(start, end)]
+
+
+def extract_page_texts(pdf_file, num_workers=None):
+    """
+    Description: Extract the text of every page of a pdf file once, in parallel for long documents.
+        PyMuPDF documents cannot be shared between processes, so each worker opens its own
+        and extracts a contiguous range of pages.
+    Input:
+        pdf_file: str, the path to the pdf file.
+        num_workers: int, the number of worker processes, defaults to the number of CPUs.
+    Return:
+        page_texts: list[str], the text of each page.
+    """
+    with pymupdf.open(pdf_file) as doc:
+        num_pages = len(doc)
+    num_workers = min(num_workers or os.cpu_count() or 1, num_pages // PARALLEL_MIN_PAGES)
+    if num_workers <= 1:
+        return _extract_page_range(pdf_file, 0, num_pages)
+
+    bounds = [num_pages * i // num_workers for i in range(num_workers + 1)]
+    # spawn: do not fork a process that may hold a CUDA context
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        ranges = executor.map(_extract_page_range, [pdf_file] * num_workers, bounds[:-1], bounds[1:])
+        return [text for page_range in ranges for text in page_range]
+
+
+def get_page_texts(pdf_file, ocr=True):
+    """
+    Description: Get the text of every page of a pdf file, extracted once per process and file version.
+        With ocr, the image-only pages of scanned books are OCR'd.
+    Input:
+        pdf_file: str, the path to the pdf file.
+        ocr: bool, whether to OCR the pages without a text layer.
+    Return:
+        page_texts: list[str], the text of each page.
+        complete: bool, False if the OCR of some pages failed, e.g. without Tesseract. These pages are empty,
+            and neither the page texts nor anything built from them should be cached.
+    """
+    stat = os.stat(pdf_file)
+    key = (os.path.abspath(pdf_file), stat.st_mtime_ns, stat.st_size, ocr)
+    if key in _page_text_cache:
+        _page_text_cache.move_to_end(key)
+        return _page_text_cache[key], True
+    page_texts = extract_page_texts(pdf_file)
+    complete = True
+    if ocr:
+        scanned_pages = find_image_only_pages(pdf_file, page_texts)
+        if scanned_pages:
+            ocr_texts = ocr_pages(pdf_file, scanned_pages)
+            for page, text in ocr_texts.items():
+                page_texts[page] = text
+            # Pages whose OCR failed are left out
+            complete = len(ocr_texts) == len(scanned_pages)
+    if complete:
+        _page_text_cache[key] = page_texts
+        if len(_page_text_cache) > PAGE_TEXT_CACHE_SIZE:
+            _page_text_cache.popitem(last=False)
+    return page_texts, complete
+
+
+def synthesize_toc(page_texts, default_title="Untitled"):
+    """
+    Description: Build a TOC from the chapter headings found at the top of the pages,
+        for pdf files without an outline, e.g. scanned books.
+    Input:
+        page_texts: list[str], the text of each page.
+        default_title: str, the title of the single chapter if no heading is found.
+    Return:
+        toc: list, [level, title, page] entries like pymupdf's get_toc, with 1-based pages.
+    """
+    toc = []
+    for page, text in enumerate(page_texts, 1):
+        lines = [line.strip() for line in text.split("\n") if line.strip()]
+        for line in lines[:HEADING_TOP_LINES]:
+            if len(line) <= HEADING_MAX_LEN and HEADING_PATTERN.match(line):
+                toc.append([1, " ".join(line.split()), page])
+                break
+    if not toc:
+        logger.warning("No chapter heading found, the whole document is a single chapter")
+        toc = [[1, default_title, 1]]
+    return toc
+
+
+class PageTextIndex:
+    def __init__(self, page_texts):
+        """
+        Description: The text of a pdf as a single string, with the character offset where each page starts,
+            to find the TOC titles near their page and cut chapters by offsets.
+            Newlines are replaced by spaces, as chapters are read as running text.
+        Input:
+            page_texts: list[str], the text of each page.
+        """
+        self.offsets = []
+        parts = []
+        position = 0
+        for text in page_texts:
+            self.offsets.append(position)
+            text = text.replace("\n", " ")
+            parts.append(text)
+            position += len(text)
+        self.offsets.append(position)
+        self.text = "".join(parts)
+
+    def page_offset(self, page):
+        """
+        Description: Get the offset where a page starts.
+        Input:
+            page: int, the 1-based page number, clamped to the document.
+        Return:
+            offset: int, the offset of the first character of the page.
+        """
+        return self.offsets[min(max(page - 1, 0), len(self.offsets) - 1)]
+
+    def find_title(self, title, page, start=0):
+        """
+        Description: Find a TOC title on its page or the next one, after start.
+            Looking only there means the same words earlier in the body are never taken for the title.
+        Input:
+            title: str, the title from the TOC.
+            page: int, the 1-based page of the title in the TOC.
+            start: int, the offset to search from, e.g. the end of the previous title.
+        Return:
+            title_start: int, the offset of the title, or of its page if it is not found.
+            title_end: int, the offset just after the title.
+        """
+        search_start = max(self.page_offset(page), start)
+        search_end = max(self.page_offset(page + 2), search_start)
+        position = self.text.find(title, search_start, search_end)
+        if position >= 0:
+            return position, position + len(title)
+
+        # The page text may break the title differently than the TOC
+        words = title.split()
+        if words:
+            pattern = re.compile(r"\s+".join(re.escape(word) for word in words))
+            match = pattern.search(self.text, search_start, search_end)
+            if match:
+                return match.start(), match.end()
+        logger.warning(f"Title '{title}' not found on page {page}, cutting at the page start")
+        return search_start, search_start
+
+
+def process_pdf(pdf_file, ocr=True):
     """
     Description: Process a pdf file and return a list of sections.
+        Each chapter is the text between the end of its title and the start of the next title,
+        the titles being looked up near their TOC page in a PageTextIndex.
+        Without an outline, the TOC is built from the chapter headings found in the text.
     Input:
         pdf_file: str, the path to the pdf file.
+        ocr: bool, whether to OCR the pages without a text layer.
     Return:
         section_list: list, a list of sections, each section is a dictionary with title, page and content.
+        complete: bool, False if the OCR of some pages failed, so the sections should not be cached.
     """
-    doc = pymupdf.open(pdf_file)
+    with pymupdf.open(pdf_file) as doc:
+        toc = doc.get_toc()
+        default_title = doc.metadata.get("title") or os.path.splitext(os.path.basename(pdf_file))[0]
+    page_texts, complete = get_page_texts(pdf_file, ocr=ocr)
+    if not toc:
+        toc = synthesize_toc(page_texts, default_title)
+    index = PageTextIndex(page_texts)
 
-    _, last_chapter_name, last_chapter_page = doc.get_toc()[0]
-    section_list = []
-    chapter_content = ""
-    for idx, toc_items in enumerate(doc.get_toc()[1:]):
-        _, current_chapter_name, current_page = toc_items
-        chapter_content = ""
-        for page in doc.pages(int(last_chapter_page)-1, int(current_page)):
-            chapter_content += page.get_text()
-
-        chapter_content = chapter_content.replace("\n", " ")
-        if len(last_chapter_name.split(" ")) == 1:
-            chapter_content = chapter_content.split(current_chapter_name)[0]
-            chapter_content = f"{last_chapter_name} ".join(chapter_content.split(last_chapter_name)[1:])
-        else:
-            chapter_content = chapter_content.split(last_chapter_name)[-1].split(current_chapter_name)[0]
-            chapter_content = split_sentences_with_newline(chapter_content)
+    # Titles are searched in TOC order, each after the previous one, so the whole text is scanned once
+    positions = []
+    title_end = 0
+    for _, chapter_name, chapter_page in toc:
+        title_start, title_end = index.find_title(chapter_name, int(chapter_page), title_end)
+        positions.append((title_start, title_end))
 
+    section_list = []
+    for idx, (_, chapter_name, chapter_page) in enumerate(toc):
+        is_last = idx == len(toc) - 1
+        content_end = len(index.text) if is_last else positions[idx + 1][0]
+        chapter_content = index.text[positions[idx][1]:content_end]
+        if is_last or len(chapter_name.split(" ")) > 1:
+            chapter_content = VI_SEGMENTER.segment(chapter_content)
 
         section_list.append(
-            {"title": last_chapter_name, 
-                "page": last_chapter_page, 
+            {"title": chapter_name, 
+                "page": chapter_page, 
                 "content": chapter_content.strip()}
         )
-        # if idx == 11:
-        #     breakpoint()
-        last_chapter_name = current_chapter_name
-        last_chapter_page = current_page
-
-    # add last chapter content
-    for page in doc.pages(int(current_page)-1, len(doc)):
-        chapter_content += page.get_text()
-    chapter_content = chapter_content.replace("\n", " ")
-    chapter_content = chapter_content.split(current_chapter_name)[-1]
-    chapter_content = split_sentences_with_newline(chapter_content)
-
-    section_list.append(
-                    {"title": current_chapter_name, 
-                        "page": current_page, 
-                        "content": chapter_content.strip()}
-                )
 
-    doc.close()
-    return section_list
+    return section_list, complete
 
 
 def cut_pdf_by_chapter(pdf_file: str, chapter_title: str, output_pdf: str):
@@ -2,45 +2,52 @@
 from datetime import datetime
 from pathlib import Path
 from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
+import multiprocessing
 import os
-import copy
 from src.logging_config import setup_logger
-from src.doc_process.process_doc import chunk_sentences
+from src.doc_process.process_doc import chunk_sentences, chunk_sentences_by_frames
 
 logger = setup_logger(__name__)
 
-def create_dtbook_xml(
-    sections: list[dict],
-    output_path: str,
-    title: str,
-    author: str,
-    publisher: str = "Unknown",
-    lang: str = "vi",
-    uid: str = "bookid-001",
-    date = datetime.now().strftime("%Y-%m-%d"),
-    split_by_sentence: bool = True,
-    chunk_size: int = 400,
-):
+# Shared by the jobs of a process, see get_chapter_writer
+_CHAPTER_WRITER = None
+
+def split_section(content: str, split_by_sentence: bool = True, chunk_size: int = 400, frame_estimator=None):
     """
-    Description: Create a strict DAISY 3-compliant DTBook XML file.
+    Description: Split the content of a section into the sentences of the DTBook.
     Input:
-        sections: list[dict], List of dicts with {"title": str, "content": str}.
-        output_path: str, File path to save the DTBook.
-        title: str, Book title.
-        author: str, Book author.
-        publisher: str, Publisher (default: "Unknown").
-        lang: str, Language code (default: "vi").
-        uid: str, Unique identifier for the book.
-        date: str, Date of the book.
-        split_by_sentence: bool, Whether to split content into sentences (default: True).
-        chunk_size: int, Number of words per chunk if splitting (default: 200) only work if split_by_sentence is False.
+        content: str, the content of the section, one sentence per line.
+        split_by_sentence: bool, Whether to keep one sentence per line, or pack them into chunks.
+        chunk_size: int, the maximum length of a chunk, only used if split_by_sentence is False.
+        frame_estimator: FrameEstimator, if set, chunks are packed up to its frame budget instead of chunk_size.
     Return:
-        output_path: str, File path to the saved DTBook.
+        sentences: list[str], the sentences, possibly empty, their index is their id in the DTBook.
     """
+    if split_by_sentence:
+        return content.split("\n")
+    if frame_estimator is not None:
+        return chunk_sentences_by_frames(content, frame_estimator, frame_estimator.max_frames)
+    return chunk_sentences(content, chunk_size)
+
 
-    # Header
-    dtbook_header = f'''<?xml version="1.0" encoding="UTF-8"?>
+DTBOOK_FOOTER = """    </bodymatter>
+    <rearmatter></rearmatter>
+  </book>
+</dtbook>
+"""
+
+
+def dtbook_header(title: str, author: str, publisher: str, lang: str, uid: str, date: str) -> str:
+    """
+    Description: Build the beginning of a DTBook, up to the opening <bodymatter> tag.
+    Input:
+        title, author, publisher, lang, uid, date: str, the metadata of the book.
+    Return:
+        header: str, the XML declaration, doctype, <head>, <frontmatter> and opening <bodymatter>.
+    """
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE dtbook PUBLIC "-//NISO//DTD dtbook 2005-3//EN"
     "http://www.daisy.org/z3986/2005/dtbook-2005-3.dtd">
 <dtbook version="2005-3" xml:lang="{lang}" xmlns="http://www.daisy.org/z3986/2005/dtbook/">
@@ -61,117 +68,129 @@ def create_dtbook_xml(
     <bodymatter>
 '''
 
-    # Body sections
-    body_content = ""
+
+def iter_dtbook_chapters(sections: list[dict], split_by_sentence: bool = True, chunk_size: int = 400,
+                         frame_estimator=None):
+    """
+    Description: Generate the <level1> element of each section, one section at a time.
+    Input:
+        sections: list[dict], List of dicts with {"title": str, "page": int, "content": str},
+            and optionally "sentences", the content already split by split_section.
+        split_by_sentence: bool, Whether to split content into sentences.
+        chunk_size: int, the maximum length of a chunk, only used if split_by_sentence is False.
+        frame_estimator: FrameEstimator, if set, chunks are packed by predicted frames, see split_section.
+    Return:
+        iterator of str: the XML of each chapter.
+    """
     for idx, sec in enumerate(sections, 0):
-        body_content += f'      <level1 class="chapter">\n'
-        body_content += f'        <pagenum>{sec["page"]}</pagenum>\n'
-        body_content += f'        <h1><sent id="c{idx}_title" data-pid="c{idx}_title">{escape(sec["title"])}</sent></h1>\n'
-        body_content += f'          <p>\n'
-        # Split line by line breaks
-        if split_by_sentence:
-            for line_id, line in enumerate(sec["content"].split("\n")):
-                line = line.strip()
-                if line:
-                    body_content += f'        <sent data-pid="c{idx}_c{line_id}" id="c{idx}_c{line_id}">{escape(line)}</sent>\n'
-        else:
-            chunks = chunk_sentences(sec["content"], chunk_size)
-            for chunk_id, chunk in enumerate(chunks):
-                chunk = chunk.strip()
-                if chunk:
-                    body_content += f'        <sent data-pid="c{idx}_c{chunk_id}" id="c{idx}_c{chunk_id}">{escape(chunk)}</sent>\n'
-        
-        
-        body_content += f'          </p>\n'
-        body_content += f'      </level1>\n'
-
-    # Footer
-    dtbook_footer = """    </bodymatter>
-    <rearmatter></rearmatter>
-  </book>
-</dtbook>
-"""
+        parts = [
+            f'      <level1 class="chapter">\n',
+            f'        <pagenum>{sec["page"]}</pagenum>\n',
+            f'        <h1><sent id="c{idx}_title" data-pid="c{idx}_title">{escape(sec["title"])}</sent></h1>\n',
+            f'          <p>\n',
+        ]
+        # Sentences split by the extraction cache, or split here
+        sentences = sec.get("sentences")
+        if sentences is None:
+            sentences = split_section(sec["content"], split_by_sentence, chunk_size, frame_estimator)
+        for sent_id, sentence in enumerate(sentences):
+            sentence = sentence.strip()
+            if sentence:
+                parts.append(f'        <sent data-pid="c{idx}_c{sent_id}" id="c{idx}_c{sent_id}">{escape(sentence)}</sent>\n')
+        parts.append(f'          </p>\n')
+        parts.append(f'      </level1>\n')
+        yield "".join(parts)
+
+
+def chapter_file_path(output_dir: str, idx: int) -> str:
+    """
+    Description: Get the path of the DTBook file of a chapter.
+    Input:
+        output_dir: str, the directory of the chapter files.
+        idx: int, the index of the chapter.
+    Return:
+        path: str, the path to the chapter file.
+    """
+    return os.path.join(output_dir, f"chapter_{idx}.dtbook.xml")
 
-    # Save file
-    Path(output_path).write_text(dtbook_header + body_content + dtbook_footer, encoding="utf-8")
-    logger.info(f"✅ Strict DTBook saved at: {output_path}")
-    return output_path
+
+def write_chapter_file(out_file: str, chapter_xml: str) -> str:
+    """
+    Description: Check that a chapter DTBook is well-formed and holds a single chapter, then save it.
+    Input:
+        out_file: str, the path to the chapter file.
+        chapter_xml: str, the chapter DTBook document.
+    Return:
+        out_file: str, the path to the saved chapter file.
+    """
+    root = etree.fromstring(chapter_xml.encode("utf-8"))
+    ns_prefix = f"{{{etree.QName(root).namespace}}}" if etree.QName(root).namespace else ""
+    if len(root.findall(f"{ns_prefix}book/{ns_prefix}bodymatter/{ns_prefix}level1")) != 1:
+        raise ValueError(f"{out_file} must hold exactly one <level1> chapter")
+    # Write then rename, so an existing chapter file is always complete
+    Path(f"{out_file}.part").write_text(chapter_xml, encoding="utf-8")
+    os.replace(f"{out_file}.part", out_file)
+    return out_file
 
 
-def split_dtbook_by_chapter(input_file: str, output_dir: str):
+def get_chapter_writer(max_workers=None):
     """
-    Description: Split a DTBook XML into per-chapter files.
+    Description: Return the process pool that writes chapter files for the current process, starting it on first use.
     Input:
-        input_file: str, the path to the input DTBook XML file.
-        output_dir: str, the directory to save the output chapter files.
+        max_workers: int, the number of workers of the pool, if it is created by this call.
     Return:
-        chapters_output_lst: list, a list of paths to the output chapter files.
+        executor: ProcessPoolExecutor, the shared pool.
     """
-    
-    chapters_output_lst = []
-
-    parser = etree.XMLParser(remove_blank_text=False)
-    tree = etree.parse(input_file, parser)
-    root = tree.getroot()
-
-    # Detect namespace
-    if root.tag.startswith("{"):
-        NS = root.tag.split("}")[0].strip("{")
-        nsmap = {None: NS}
-        ns_prefix = f"{{{NS}}}"
-    else:
-        NS = None
-        nsmap = None
-        ns_prefix = ""
-
-    bodymatter = root.find(f".//{ns_prefix}bodymatter")
-    if bodymatter is None:
-        raise ValueError("No <bodymatter> found in the DTBook XML")
-
-    chapters = bodymatter.findall(f"{ns_prefix}level1")
-    if not chapters:
-        raise ValueError("No <level1> chapters found in the DTBook XML")
-
-    for idx, chapter in enumerate(chapters):
-        chapter_copy = copy.deepcopy(chapter)
-
-        # New <dtbook>
-        new_root = etree.Element("dtbook", nsmap=nsmap)
-        new_root.attrib.update(root.attrib)
-
-        # Copy <head>
-        head = root.find(f"{ns_prefix}head")
-        if head is not None:
-            new_root.append(copy.deepcopy(head))
-
-        # Create <book>
-        book_elem = etree.Element("book", nsmap=nsmap)
-
-        # Copy <frontmatter> (with content)
-        front = root.find(f".//{ns_prefix}frontmatter")
-        book_elem.append(copy.deepcopy(front) if front is not None else etree.Element("frontmatter", nsmap=nsmap))
-
-        # New <bodymatter> with one chapter
-        new_body = etree.Element("bodymatter", nsmap=nsmap)
-        new_body.append(chapter_copy)
-        book_elem.append(new_body)
-
-        # Copy <rearmatter>
-        rear = root.find(f"{ns_prefix}rearmatter")
-        book_elem.append(copy.deepcopy(rear) if rear is not None else etree.Element("rearmatter", nsmap=nsmap))
-
-        # Attach <book> to root
-        new_root.append(book_elem)
-
-        # Save file
-        out_file = os.path.join(output_dir, f"chapter_{idx}.dtbook.xml")
-        etree.ElementTree(new_root).write(
-            out_file,
-            pretty_print=True,
-            encoding="utf-8",
-            xml_declaration=True,
-            doctype='<!DOCTYPE dtbook PUBLIC "-//NISO//DTD dtbook 2005-3//EN"\n    "http://www.daisy.org/z3986/2005/dtbook-2005-3.dtd">'
-        )
-        logger.info(f"✅ Saved {out_file}")
-        chapters_output_lst.append(out_file)
-    return chapters_output_lst
\ No newline at end of file
+    global _CHAPTER_WRITER
+    if _CHAPTER_WRITER is None:
+        # spawn: the pool must not fork a process holding a CUDA context
+        _CHAPTER_WRITER = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    return _CHAPTER_WRITER
+
+
+def create_dtbook_xml(
+    sections: list[dict],
+    output_path: str,
+    title: str,
+    author: str,
+    publisher: str = "Unknown",
+    lang: str = "vi",
+    uid: str = "bookid-001",
+    date = datetime.now().strftime("%Y-%m-%d"),
+    split_by_sentence: bool = True,
+    chunk_size: int = 400,
+    on_chapter = None,
+    frame_estimator = None,
+):
+    """
+    Description: Create a strict DAISY 3-compliant DTBook XML file.
+        Chapters are written to the file as they are generated, so only one chapter is held in memory.
+    Input:
+        sections: list[dict], List of dicts with {"title": str, "content": str},
+            and optionally "sentences", the content already split by split_section.
+        output_path: str, File path to save the DTBook.
+        title: str, Book title.
+        author: str, Book author.
+        publisher: str, Publisher (default: "Unknown").
+        lang: str, Language code (default: "vi").
+        uid: str, Unique identifier for the book.
+        date: str, Date of the book.
+        split_by_sentence: bool, Whether to split content into sentences (default: True).
+        chunk_size: int, Number of words per chunk if splitting (default: 200) only work if split_by_sentence is False.
+        on_chapter: callable(idx, chapter_xml), if set, called with each chapter as its own DTBook document,
+            e.g. to write it with write_chapter_file.
+        frame_estimator: FrameEstimator, if set, chunks are packed by predicted frames, see split_section.
+    Return:
+        output_path: str, File path to the saved DTBook.
+    """
+    header = dtbook_header(title, author, publisher, lang, uid, date)
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(header)
+        for idx, chapter in enumerate(iter_dtbook_chapters(sections, split_by_sentence, chunk_size, frame_estimator)):
+            f.write(chapter)
+            if on_chapter is not None:
+                on_chapter(idx, header + chapter + DTBOOK_FOOTER)
+        f.write(DTBOOK_FOOTER)
+    logger.info(f"✅ Strict DTBook saved at: {output_path}")
+    return output_path
+
@@ -1,5 +1,6 @@
-from src.doc_process.process_doc import process_pdf, chunk_sentences
-from src.doc_process.process_xml import create_dtbook_xml, split_dtbook_by_chapter
+from src.doc_process.process_doc import process_pdf, chunk_sentences, chunk_sentences_by_frames
+from src.doc_process.process_xml import create_dtbook_xml, split_section, chapter_file_path, write_chapter_file, get_chapter_writer
+from src.doc_process.extraction_cache import ExtractionCache
 from datetime import datetime
 import os
 from src.logging_config import setup_logger
@@ -7,18 +8,24 @@ logger = setup_logger(__name__)
 
 class TextProcessor:
     
-    def __init__(self, input_file=None, output_dir=None, split_by_sentence=False, chunk_size=200):
+    def __init__(self, input_file=None, output_dir=None, split_by_sentence=False, chunk_size=200,
+                 extraction_cache_dir="data/cache/extraction", frame_estimator=None):
         """
         Description: Initialize the TextProcessor class.
         Input:
             input_file: str, the path to the input pdf file.
             output_dir: str, the directory to save the output files.
+            extraction_cache_dir: str, the directory of the cache of extracted sections, None to disable it.
+            frame_estimator: FrameEstimator, if set, chunks are packed up to its budget of predicted
+                acoustic frames instead of chunk_size characters.
         """
         self.input_file = input_file
         self.output_dir = output_dir
         self.split_by_sentence = split_by_sentence
         self.chunk_size = chunk_size
+        self.frame_estimator = frame_estimator
         self.processed_lst = []
+        self.extraction_cache = ExtractionCache(extraction_cache_dir) if extraction_cache_dir else None
         
         if self.output_dir is not None and not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
@@ -28,6 +35,7 @@ class TextProcessor:
                 date = datetime.now().strftime("%Y-%m-%d"), 
                 publisher = "Unknown", 
                 uid = "000-xxx-xxx-000",
+                concurrent = False,
                 ):
         """
         Description: Create a list of xml chapters from a pdf file, split by sentence.
@@ -37,26 +45,67 @@ class TextProcessor:
             date: str, the date of the book.
             publisher: str, the publisher of the book.
             uid: str, the uid of the book.
+            concurrent: bool, check and save the chapter files in a process pool, and return at once.
         Return:
-            xml_chapters_lst: list, a list of xml chapters.
+            xml_chapters_lst: list, a list of xml chapters, or with concurrent, a list of futures
+                resolving to them, in chapter order.
         """
         if self.input_file.lower().endswith('.pdf'):
-            self.processed_lst = process_pdf(self.input_file)
+            self.processed_lst = self.extract_sections()
             output_file = title.replace(".pdf",".xml")
-            dtbook_xml = create_dtbook_xml(self.processed_lst, output_path=f"{self.output_dir}/{output_file}",
-                                title=title,
-                                author= author,
-                                date=date,
-                                publisher=publisher,
-                                uid=uid,
-                                split_by_sentence=self.split_by_sentence,
-                                chunk_size=self.chunk_size)
-            xml_chapters_lst = split_dtbook_by_chapter(dtbook_xml, self.output_dir)
+            xml_chapters_lst = []
+
+            def write_chapter(idx, chapter_xml):
+                out_file = chapter_file_path(self.output_dir, idx)
+                if concurrent:
+                    xml_chapters_lst.append(get_chapter_writer().submit(write_chapter_file, out_file, chapter_xml))
+                else:
+                    xml_chapters_lst.append(write_chapter_file(out_file, chapter_xml))
+
+            # The chapter files are written along with the full DTBook
+            create_dtbook_xml(self.processed_lst, output_path=f"{self.output_dir}/{output_file}",
+                              title=title,
+                              author= author,
+                              date=date,
+                              publisher=publisher,
+                              uid=uid,
+                              split_by_sentence=self.split_by_sentence,
+                              chunk_size=self.chunk_size,
+                              on_chapter=write_chapter,
+                              frame_estimator=self.frame_estimator)
             return xml_chapters_lst
         else:
             logger.error("Unsupported file format. Only PDF and XML are supported.")
             raise ValueError("Unsupported file format. Only PDF and XML are supported.")
     
+    def extract_sections(self):
+        """
+        Description: Extract the sections of the pdf file with their sentence splits,
+            from the extraction cache if the same pdf was already processed with the same splitting.
+        Return:
+            sections: list[dict], the sections, with title, page, content and sentences.
+        """
+        key = None
+        if self.extraction_cache is not None:
+            key = ExtractionCache.make_key(self.input_file, self.split_by_sentence, self.chunk_size,
+                                           self.frame_estimator)
+            sections = self.extraction_cache.lookup(key)
+            if sections is not None:
+                logger.info(f"Loaded {len(sections)} sections of {self.input_file} from the extraction cache")
+                return sections
+
+        sections, complete = process_pdf(self.input_file)
+        for section in sections:
+            section["sentences"] = split_section(section["content"], self.split_by_sentence, self.chunk_size,
+                                               self.frame_estimator)
+        if key is not None:
+            if complete:
+                self.extraction_cache.store(key, sections)
+            else:
+                # Extract the pdf again next time, e.g. once Tesseract is installed
+                logger.warning(f"Not caching the sections of {self.input_file}, the OCR of some pages failed")
+        return sections
+
     def create_tsv_for_tts(self, promt_wav_file, prompt_text, output_dir='tsv_dir/'):
         """
         Description: Create tsv files for TTS split with each line.
@@ -112,7 +161,10 @@ class TextProcessor:
                 os.makedirs(f"{output_dir}/{chapter_name}")
                 
             lines = chapter.get('title')+"\n"+chapter.get('content')
-            chunks = chunk_sentences(lines, max_len=self.chunk_size)
+            if self.frame_estimator is not None:
+                chunks = chunk_sentences_by_frames(lines, self.frame_estimator, self.frame_estimator.max_frames)
+            else:
+                chunks = chunk_sentences(lines, max_len=self.chunk_size)
             for j, chunk in enumerate(chunks):
                 with open(f"{output_dir}/{chapter_name}/chapter_{i}.tsv", "a", encoding="utf-8") as f:
                     f.write(f"{chapter_name}_{j}\t{prompt_text}\t{promt_wav_file}\t{chunk.strip()}\n")
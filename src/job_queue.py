@@ -0,0 +1,421 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from multiprocessing.connection import wait
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Columns of the jobs table that a worker may update through JobStatus
+STATUS_FIELDS = ("status", "progress", "total", "result_path")
+# A job whose worker died this many times is failed instead of requeued, so it cannot crash workers forever
+MAX_WORKER_DEATHS = 3
+# Minimum seconds between the starts of two workers in one slot, so a worker failing at startup does not respawn in a loop
+WORKER_RESTART_DELAY = 10
+
+
+class JobQueue:
+    def __init__(self, db_path="data/jobs.db"):
+        """
+        Description: A job queue stored in a local SQLite database, so jobs survive server restarts.
+        Input:
+            db_path: str, the path to the SQLite database file.
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    status TEXT,
+                    progress REAL DEFAULT 0,
+                    total REAL DEFAULT 1,
+                    result_path TEXT,
+                    payload TEXT NOT NULL,
+                    priority INTEGER DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    worker_pid INTEGER,
+                    worker_deaths INTEGER DEFAULT 0
+                )"""
+            )
+            # Databases created before the columns existed
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "worker_pid" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN worker_pid INTEGER")
+            if "worker_deaths" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN worker_deaths INTEGER DEFAULT 0")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def submit(self, job_id, payload, priority=0):
+        """
+        Description: Add a job to the queue.
+        Input:
+            job_id: str, the id of the job.
+            payload: dict, the arguments of the job, must be JSON serializable.
+            priority: int, jobs with a higher priority are dispatched first, FIFO among equal priorities.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, state, status, payload, priority, created_at, updated_at) "
+                "VALUES (?, 'queued', 'queued', ?, ?, ?, ?)",
+                (job_id, json.dumps(payload), priority, now, now),
+            )
+
+    def claim(self, worker_pid=None):
+        """
+        Description: Take the next queued job and mark it as running.
+        Input:
+            worker_pid: int, the pid of the worker process claiming the job, to requeue it if the worker dies.
+        Return:
+            job: tuple, (job_id, payload), or None if no job is queued.
+        """
+        conn = self._connect()
+        try:
+            # Lock the database so that two workers never claim the same job
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT job_id, payload FROM jobs WHERE state = 'queued' "
+                "ORDER BY priority DESC, created_at ASC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = 'running', status = 'Initializing...', worker_pid = ?, updated_at = ? "
+                "WHERE job_id = ?",
+                (worker_pid, time.time(), row["job_id"]),
+            )
+            conn.commit()
+            return row["job_id"], json.loads(row["payload"])
+        finally:
+            conn.close()
+
+    def update(self, job_id, **fields):
+        """
+        Description: Update the status fields of a job.
+        Input:
+            job_id: str, the id of the job.
+            fields: the columns to update, among state and STATUS_FIELDS.
+        """
+        if not fields:
+            return
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET {columns}, updated_at = ? WHERE job_id = ?",
+                (*fields.values(), time.time(), job_id),
+            )
+
+    def complete(self, job_id):
+        """
+        Description: Mark a running job as finished or failed, depending on its last status.
+        Input:
+            job_id: str, the id of the job.
+        Return:
+            state: str, "finished" or "error".
+        """
+        job = self.get(job_id)
+        state = "finished" if job and job["status"] == "finished" else "error"
+        self.update(job_id, state=state)
+        return state
+
+    def requeue(self, job_id):
+        """
+        Description: Put a finished or failed job back in the queue, e.g. to resume it after an error.
+        Input:
+            job_id: str, the id of the job.
+        Return:
+            requeued: bool, False if the job does not exist or is still queued or running.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'queued', status = 'queued', worker_deaths = 0, updated_at = ? "
+                "WHERE job_id = ? AND state IN ('finished', 'error')",
+                (time.time(), job_id),
+            )
+            return cursor.rowcount > 0
+
+    def requeue_running(self):
+        """
+        Description: Put back in the queue the jobs that were running when the server stopped.
+        Return:
+            count: int, the number of requeued jobs.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'queued', status = 'queued', updated_at = ? WHERE state = 'running'",
+                (time.time(),),
+            )
+            return cursor.rowcount
+
+    def requeue_worker(self, worker_pid):
+        """
+        Description: Put back in the queue the jobs a dead worker was running,
+            or fail those whose worker died MAX_WORKER_DEATHS times.
+        Input:
+            worker_pid: int, the pid of the dead worker.
+        Return:
+            jobs: dict, the new state, "queued" or "error", of each job the worker was running.
+        """
+        jobs = {}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT job_id, worker_deaths FROM jobs WHERE state = 'running' AND worker_pid = ?",
+                (worker_pid,),
+            ).fetchall()
+            for row in rows:
+                deaths = (row["worker_deaths"] or 0) + 1
+                if deaths >= MAX_WORKER_DEATHS:
+                    state, status = "error", f"error: the worker died {deaths} times running this job"
+                else:
+                    state, status = "queued", "queued"
+                conn.execute(
+                    "UPDATE jobs SET state = ?, status = ?, worker_pid = NULL, worker_deaths = ?, updated_at = ? "
+                    "WHERE job_id = ?",
+                    (state, status, deaths, time.time(), row["job_id"]),
+                )
+                jobs[row["job_id"]] = state
+        return jobs
+
+    def get(self, job_id):
+        """
+        Description: Get the status of a job.
+        Input:
+            job_id: str, the id of the job.
+        Return:
+            job: dict, the state, status, progress, total and result_path of the job, or None if not found.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT state, status, progress, total, result_path FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+
+class JobStatus(dict):
+    """
+    A status dict that also writes its status fields to the job queue database,
+    and sends every change (stage, chapter, chunk, rtf, eta, ...) as an event to the server.
+    """
+
+    def __init__(self, queue, job_id, events=None):
+        super().__init__()
+        self.queue = queue
+        self.job_id = job_id
+        self.events = events
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if key in STATUS_FIELDS:
+            self.queue.update(self.job_id, **{key: value})
+        if self.events is not None:
+            self.events.put({"job_id": self.job_id, key: value})
+
+    def update(self, *args, **kwargs):
+        fields = dict(*args, **kwargs)
+        super().update(fields)
+        self.queue.update(self.job_id, **{k: v for k, v in fields.items() if k in STATUS_FIELDS})
+        if self.events is not None:
+            self.events.put({"job_id": self.job_id, **fields})
+
+
+class EventHub:
+    def __init__(self, events):
+        """
+        Description: Forward the events sent by the workers to the server's subscribers,
+            and keep the latest value of every field of every job until it finishes or fails.
+        Input:
+            events: multiprocessing.Queue, the queue the workers put their events in.
+        """
+        self.events = events
+        self.latest = {}
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            job_id = event.pop("job_id")
+            with self.lock:
+                if event.get("state") in ("finished", "error"):
+                    # The database keeps the final status, the job sends no more events
+                    self.latest.pop(job_id, None)
+                else:
+                    self.latest.setdefault(job_id, {}).update(event)
+                subscribers = list(self.subscribers.get(job_id, []))
+            for loop, queue in subscribers:
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+                except RuntimeError:
+                    pass  # the subscriber's event loop is closed
+
+    def subscribe(self, job_id):
+        """
+        Description: Start receiving the events of a job. Must be called from the event loop.
+        Input:
+            job_id: str, the id of the job.
+        Return:
+            queue: asyncio.Queue, the queue the events of the job are put in.
+        """
+        queue = asyncio.Queue()
+        with self.lock:
+            self.subscribers.setdefault(job_id, []).append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        with self.lock:
+            self.subscribers[job_id] = [s for s in self.subscribers.get(job_id, []) if s[1] is not queue]
+            if not self.subscribers[job_id]:
+                del self.subscribers[job_id]
+
+    def snapshot(self, job_id):
+        """
+        Description: Get the latest value of every field sent for a job.
+        Input:
+            job_id: str, the id of the job.
+        Return:
+            fields: dict, empty if no event was received for the job.
+        """
+        with self.lock:
+            return dict(self.latest.get(job_id, {}))
+
+    def stop(self):
+        self.events.put(None)
+        self.thread.join(timeout=5)
+
+
+def run_worker(db_path, job_fn, stop_event, init_fn=None, poll_interval=1.0, events=None):
+    """
+    Description: Main loop of a worker process: take queued jobs one at a time until stop_event is set.
+    Input:
+        db_path: str, the path to the job queue database.
+        job_fn: callable, job_fn(job_id, status_dict, payload) runs one job.
+        stop_event: multiprocessing.Event, set to stop the worker after its current job.
+        init_fn: callable, called once when the worker starts, e.g. to load the TTS model.
+        poll_interval: float, seconds to wait when the queue is empty.
+        events: multiprocessing.Queue, where the progress events of the jobs are sent, or None.
+    """
+    if init_fn is not None:
+        init_fn()
+    queue = JobQueue(db_path)
+    logger.info(f"Worker {os.getpid()} ready")
+
+    while not stop_event.is_set():
+        job = queue.claim(os.getpid())
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+
+        job_id, payload = job
+        logger.info(f"Worker {os.getpid()} running job {job_id}")
+        status_dict = JobStatus(queue, job_id, events)
+        try:
+            job_fn(job_id, status_dict, payload)
+        except Exception as e:
+            logger.error(f"Error in job {job_id}: {e}", exc_info=True)
+            status_dict["status"] = f"error: {e}"
+        state = queue.complete(job_id)
+        if events is not None:
+            events.put({"job_id": job_id, "state": state})
+
+
+class WorkerPool:
+    def __init__(self, db_path, job_fn, num_workers=1, init_fn=None):
+        """
+        Description: A fixed number of long-lived worker processes consuming the job queue.
+            A monitor thread replaces a worker that dies, and requeues the job it was running.
+        Input:
+            db_path: str, the path to the job queue database.
+            job_fn: callable, the function running one job, must be importable by the workers.
+            num_workers: int, the number of worker processes.
+            init_fn: callable, called once in each worker when it starts.
+        """
+        self.db_path = db_path
+        self.job_fn = job_fn
+        self.num_workers = num_workers
+        self.init_fn = init_fn
+        # spawn: workers must not inherit a CUDA context, and it works the same on Windows
+        self.ctx = multiprocessing.get_context("spawn")
+        self.stop_event = self.ctx.Event()
+        self.events = self.ctx.Queue()
+        self.processes = []
+        # Start time of the worker of each slot
+        self.started = []
+        self.lock = threading.Lock()
+        self.monitor = None
+
+    def _spawn(self, slot):
+        process = self.ctx.Process(
+            target=run_worker,
+            args=(self.db_path, self.job_fn, self.stop_event, self.init_fn),
+            kwargs={"events": self.events},
+        )
+        process.start()
+        self.processes[slot] = process
+        self.started[slot] = time.time()
+
+    def start(self):
+        with self.lock:
+            self.processes = [None] * self.num_workers
+            self.started = [0.0] * self.num_workers
+            for slot in range(self.num_workers):
+                self._spawn(slot)
+        self.monitor = threading.Thread(target=self._monitor, daemon=True)
+        self.monitor.start()
+        logger.info(f"Started {self.num_workers} workers")
+
+    def _monitor(self, interval=1.0):
+        queue = JobQueue(self.db_path)
+        while not self.stop_event.is_set():
+            with self.lock:
+                sentinels = [process.sentinel for process in self.processes if process is not None]
+            wait(sentinels, timeout=interval)
+            with self.lock:
+                if self.stop_event.is_set():
+                    break
+                for slot, process in enumerate(self.processes):
+                    if process is not None and not process.is_alive():
+                        jobs = queue.requeue_worker(process.pid)
+                        logger.error(f"Worker {process.pid} died with exit code {process.exitcode}, "
+                                     f"restarting it. Its jobs: {jobs or 'none'}")
+                        for job_id, state in jobs.items():
+                            self.events.put({"job_id": job_id, "state": state})
+                        process.close()
+                        self.processes[slot] = None
+                    if self.processes[slot] is None and time.time() - self.started[slot] >= WORKER_RESTART_DELAY:
+                        self._spawn(slot)
+
+    def stop(self, timeout=10):
+        """
+        Description: Ask the workers to stop, and terminate those still busy after timeout.
+            Their jobs stay 'running' in the database and are requeued on the next start.
+        Input:
+            timeout: float, seconds to wait for each worker.
+        """
+        self.stop_event.set()
+        if self.monitor is not None:
+            self.monitor.join()
+            self.monitor = None
+        with self.lock:
+            for process in filter(None, self.processes):
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
+            self.processes = []
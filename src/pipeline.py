@@ -0,0 +1,176 @@
+import queue
+import threading
+import time
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Put in a stage's input queue after the last item
+_END = object()
+
+
+class Stage:
+    def __init__(self, name, fn, workers=1, queue_size=8):
+        """
+        Description: A stage of a Pipeline.
+        Input:
+            name: str, the name of the stage in the metrics.
+            fn: callable, a generator function: fn(item) yields the items of the next stage (none, one or several).
+            workers: int, the number of threads running fn at the same time.
+            queue_size: int, the number of items waiting for the stage before the previous one blocks.
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.running = 0
+        self.workers_left = workers
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    def __init__(self, stages, metrics_callback=None, metrics_interval=5.0):
+        """
+        Description: Run items through a chain of stages, each with its own worker threads,
+            connected by bounded queues so that a slow stage holds back the ones before it
+            instead of letting items pile up in memory.
+        Input:
+            stages: list[Stage], the stages, in order.
+            metrics_callback: callable, called as metrics_callback(metrics) every metrics_interval seconds
+                while the pipeline runs, and once at the end.
+            metrics_interval: float, seconds between two metrics_callback calls.
+        """
+        self.stages = stages
+        self.metrics_callback = metrics_callback
+        self.metrics_interval = metrics_interval
+        self.queues = []
+        self.start_time = None
+        self.error = None
+        self.failed = threading.Event()
+
+    def _put(self, q, item):
+        # Never block forever on a queue that nobody reads after a failure
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if not self._put(self.queues[0], item):
+                    return
+        except BaseException as e:
+            self._fail(e)
+        self._put(self.queues[0], _END)
+
+    def _work(self, index, outputs):
+        stage = self.stages[index]
+        in_queue = self.queues[index]
+        out_queue = self.queues[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            while True:
+                item = self._get(in_queue)
+                if item is _END:
+                    # Let the other workers of the stage see the end too
+                    self._put(in_queue, _END)
+                    break
+                with stage.lock:
+                    stage.running += 1
+                start = time.monotonic()
+                blocked = 0.0
+                for output in stage.fn(item):
+                    waited = time.monotonic()
+                    if out_queue is None:
+                        outputs.append(output)
+                    elif not self._put(out_queue, output):
+                        return
+                    blocked += time.monotonic() - waited
+                with stage.lock:
+                    stage.running -= 1
+                    stage.items += 1
+                    # Time spent waiting for the next stage is not time spent working
+                    stage.busy += time.monotonic() - start - blocked
+                    stage.blocked += blocked
+        except BaseException as e:
+            self._fail(e)
+            return
+
+        with stage.lock:
+            stage.workers_left -= 1
+            last = stage.workers_left == 0
+        if last and out_queue is not None:
+            self._put(out_queue, _END)
+
+    def _fail(self, error):
+        if not self.failed.is_set():
+            self.error = error
+            logger.error(f"Pipeline failed: {error}", exc_info=error)
+            self.failed.set()
+
+    def run(self, items):
+        """
+        Description: Run items through the pipeline and wait for all of them to come out.
+        Input:
+            items: iterable, the items of the first stage, consumed lazily.
+        Return:
+            outputs: list, the items yielded by the last stage, in the order they were produced.
+        """
+        self.queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        self.start_time = time.monotonic()
+        outputs = []
+        threads = [threading.Thread(target=self._feed, args=(items,), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            stage.workers_left = stage.workers
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, args=(index, outputs), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.metrics_interval)
+                if self.metrics_callback is not None and thread.is_alive():
+                    self.metrics_callback(self.metrics())
+        if self.metrics_callback is not None:
+            self.metrics_callback(self.metrics())
+        logger.info(f"Pipeline metrics: {self.metrics()}")
+
+        if self.error is not None:
+            raise self.error
+        return outputs
+
+    def metrics(self):
+        """
+        Description: Get the occupancy of every stage since the pipeline started.
+        Return:
+            metrics: dict, for each stage name: the number of items it finished, its occupancy
+                (the share of its workers' time spent working), the share of time spent waiting
+                for the next stage, the number of items running and the number of items queued.
+        """
+        elapsed = max(time.monotonic() - self.start_time, 1e-9) if self.start_time else 1e-9
+        metrics = {}
+        for stage, q in zip(self.stages, self.queues or [None] * len(self.stages)):
+            capacity = elapsed * stage.workers
+            metrics[stage.name] = {
+                "items": stage.items,
+                "occupancy": round(min(stage.busy / capacity, 1.0), 3),
+                "blocked": round(min(stage.blocked / capacity, 1.0), 3),
+                "running": stage.running,
+                "queued": q.qsize() if q is not None else 0,
+            }
+        return metrics
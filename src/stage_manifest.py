@@ -0,0 +1,54 @@
+import json
+import os
+import threading
+
+
+class StageManifest:
+    def __init__(self, manifest_path):
+        """
+        Description: Record which stages of a job are complete, and their outputs, in a JSON file,
+            so that a re-run of the job can skip them.
+        Input:
+            manifest_path: str, the path to the JSON manifest file.
+        """
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.stages = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.stages = json.load(f)
+
+    def is_done(self, stage):
+        """
+        Description: Check whether a stage is complete.
+        Input:
+            stage: str, the name of the stage.
+        Return:
+            done: bool, True if the stage was marked done.
+        """
+        return stage in self.stages
+
+    def get(self, stage):
+        """
+        Description: Get the outputs recorded for a complete stage.
+        Input:
+            stage: str, the name of the stage.
+        Return:
+            outputs: the outputs given to mark_done, or None if the stage is not complete.
+        """
+        return self.stages.get(stage)
+
+    def mark_done(self, stage, outputs=True):
+        """
+        Description: Mark a stage as complete and save the manifest.
+        Input:
+            stage: str, the name of the stage.
+            outputs: JSON serializable outputs of the stage, e.g. the paths it created.
+        """
+        with self.lock:
+            self.stages[stage] = outputs
+            # Write to a temporary file first so a crash never leaves a truncated manifest
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.stages, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+from src.logging_config import setup_logger
+
+logger = setup_logger(__name__)
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# Seconds between two scans for abandoned partial uploads
+CLEANUP_INTERVAL = 3600
+
+
+class UploadStore:
+    def __init__(self, upload_dir, partial_ttl=24 * 3600):
+        """
+        Description: Store uploaded files by content hash, receiving them in chunks that can be resumed.
+            Partial uploads live in upload_dir/partial until they are completed, or until they have not
+            received a chunk for partial_ttl seconds.
+            The methods may be called from several threads.
+        Input:
+            upload_dir: str, the directory to save the uploaded files.
+            partial_ttl: float, the age in seconds after which an untouched partial upload is deleted.
+        """
+        self.upload_dir = Path(upload_dir)
+        self.partial_dir = self.upload_dir / "partial"
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        self.partial_ttl = partial_ttl
+        # upload_id -> (sha256 object, number of bytes hashed), so chunks are hashed as they arrive
+        self.hashers = {}
+        # upload_id -> lock, so two requests on one upload do not interleave their writes
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.last_cleanup = 0.0
+
+    def _part_path(self, upload_id):
+        try:
+            # The id comes from the client, never let it point outside partial_dir
+            upload_id = str(uuid.UUID(upload_id))
+        except ValueError:
+            raise KeyError(upload_id)
+        return self.partial_dir / f"{upload_id}.part"
+
+    def _meta_path(self, upload_id):
+        return self._part_path(upload_id).with_suffix(".json")
+
+    def _upload_lock(self, upload_id):
+        if not self._part_path(upload_id).exists():
+            raise KeyError(upload_id)
+        with self.lock:
+            return self.locks.setdefault(upload_id, threading.Lock())
+
+    def _forget(self, upload_id):
+        with self.lock:
+            self.hashers.pop(upload_id, None)
+            self.locks.pop(upload_id, None)
+
+    def cleanup(self):
+        """
+        Description: Delete the partial uploads that have not received a chunk for partial_ttl seconds.
+        Return:
+            removed: int, the number of partial uploads deleted.
+        """
+        self.last_cleanup = time.time()
+        removed = 0
+        for part_path in self.partial_dir.glob("*.part"):
+            upload_id = part_path.stem
+            try:
+                with self._upload_lock(upload_id):
+                    if self.last_cleanup - part_path.stat().st_mtime < self.partial_ttl:
+                        continue
+                    part_path.unlink()
+                    part_path.with_suffix(".json").unlink(missing_ok=True)
+            except (KeyError, FileNotFoundError):
+                # Completed meanwhile
+                continue
+            self._forget(upload_id)
+            removed += 1
+        # Metadata left without its .part file by a crash in start
+        for meta_path in self.partial_dir.glob("*.json"):
+            try:
+                if (not meta_path.with_suffix(".part").exists()
+                        and self.last_cleanup - meta_path.stat().st_mtime >= self.partial_ttl):
+                    meta_path.unlink()
+            except FileNotFoundError:
+                continue
+        if removed:
+            logger.info(f"Deleted {removed} abandoned partial uploads")
+        return removed
+
+    def start(self, filename):
+        """
+        Description: Start a new upload.
+        Input:
+            filename: str, the name of the uploaded file, only its extension is kept.
+        Return:
+            upload_id: str, the id to send the chunks to.
+        """
+        if time.time() - self.last_cleanup >= CLEANUP_INTERVAL:
+            self.cleanup()
+        upload_id = str(uuid.uuid4())
+        # The metadata first: cleanup drops the pair once it sees the .part file
+        with open(self._meta_path(upload_id), "w", encoding="utf-8") as f:
+            json.dump({"filename": filename}, f, ensure_ascii=False)
+        self._part_path(upload_id).touch()
+        with self.lock:
+            self.hashers[upload_id] = (hashlib.sha256(), 0)
+        return upload_id
+
+    def offset(self, upload_id):
+        """
+        Description: Get the number of bytes received so far, to resume an interrupted upload.
+        Input:
+            upload_id: str, the id of the upload.
+        Return:
+            offset: int, the size of the partial file.
+        """
+        part_path = self._part_path(upload_id)
+        if not part_path.exists():
+            raise KeyError(upload_id)
+        return part_path.stat().st_size
+
+    def _hasher(self, upload_id, offset):
+        with self.lock:
+            hasher, hashed = self.hashers.get(upload_id, (None, -1))
+        if hashed != offset:
+            # e.g. after a server restart: hash what was received so far once, then continue on the fly
+            hasher = hashlib.sha256()
+            with open(self._part_path(upload_id), "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(block)
+        return hasher
+
+    def append(self, upload_id, offset, data):
+        """
+        Description: Append a chunk to an upload.
+        Input:
+            upload_id: str, the id of the upload.
+            offset: int, the position of the chunk in the file, must be the current size of the upload.
+            data: bytes, the chunk.
+        Return:
+            offset: int, the size of the upload after the chunk.
+        """
+        with self._upload_lock(upload_id):
+            current = self.offset(upload_id)
+            if offset != current:
+                raise ValueError(f"Chunk at offset {offset}, expected {current}")
+            hasher = self._hasher(upload_id, current)
+            with open(self._part_path(upload_id), "ab") as f:
+                f.write(data)
+            hasher.update(data)
+            with self.lock:
+                self.hashers[upload_id] = (hasher, current + len(data))
+            return current + len(data)
+
+    def complete(self, upload_id):
+        """
+        Description: Finish an upload and move it to its content-addressed path.
+            If a file with the same content was uploaded before, the new copy is dropped.
+        Input:
+            upload_id: str, the id of the upload.
+        Return:
+            file_path: str, the path to the stored file.
+            sha256: str, the hex SHA-256 of the file.
+            duplicate: bool, True if the file had already been uploaded.
+        """
+        with self._upload_lock(upload_id):
+            size = self.offset(upload_id)
+            hasher = self._hasher(upload_id, size)
+            sha256 = hasher.hexdigest()
+
+            with open(self._meta_path(upload_id), "r", encoding="utf-8") as f:
+                filename = json.load(f)["filename"]
+            suffix = Path(filename).suffix.lower() or ".pdf"
+            file_path = self.upload_dir / f"{sha256}{suffix}"
+
+            duplicate = file_path.exists()
+            if duplicate:
+                self._part_path(upload_id).unlink()
+                logger.info(f"Upload {filename} is a duplicate of {file_path}")
+            else:
+                os.replace(self._part_path(upload_id), file_path)
+            self._meta_path(upload_id).unlink()
+        self._forget(upload_id)
+        return str(file_path), sha256, duplicate
+
+    def find(self, sha256):
+        """
+        Description: Find a stored file by content hash.
+        Input:
+            sha256: str, the lowercase hex SHA-256 of the file.
+        Return:
+            file_path: str, the path to the stored file, or None.
+        """
+        # The hash is used in a glob pattern, reject anything but a hex digest
+        if not SHA256_PATTERN.match(sha256):
+            raise ValueError(f"Invalid SHA-256: {sha256!r}")
+        for file_path in self.upload_dir.glob(f"{sha256}.*"):
+            if file_path.is_file():
+                return str(file_path)
+        return None
@@ -1,3 +1,4 @@
+import hashlib
 
 
 def read_txt_file(file_path):
@@ -23,4 +24,19 @@ def ms_to_anemone_time(ms: int) -> str:
     total_seconds = ms / 1000.0
     minutes = int(total_seconds // 60)
     seconds = total_seconds % 60
-    return f"{minutes}:{seconds:05.2f}"  # e.g. "63:15.20"
\ No newline at end of file
+    return f"{minutes}:{seconds:05.2f}"  # e.g. "63:15.20"
+
+def file_sha256(file_path, block_size=1 << 20):
+    """
+    Description: Compute the SHA-256 of a file without loading it in memory.
+    Input:
+        file_path: str, the path to the file.
+        block_size: int, the number of bytes read at a time.
+    Return:
+        digest: str, the hex digest of the file content.
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()